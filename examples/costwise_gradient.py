@@ -72,14 +72,11 @@ if __name__ == '__main__':
             for _ in range(10000):
                 outcomes.append(graph.get_outcome())
 
-            # find the distribution of end-nodes
+            # find the distribution of end-nodes, as expected counts out of iters games
             iters = 10000
-            output_nodes = {2: 0, 7: 0, 8: 0, 9: 0, 10: 0, 11: 0, 12: 0}
-            for _ in range(iters):
-                outnid = graph.get_outcome_node()
-                output_nodes[outnid] += 1
+            output_nodes = graph.outcome_node_distribution()
 
-            likelyhoods.append(output_nodes[nid])
+            likelyhoods.append(output_nodes[nid] * iters)
             means.append(float(sum(outcomes))/len(outcomes))
             mins.append(min(outcomes))
             maxes.append(max(outcomes))
@@ -87,17 +84,13 @@ if __name__ == '__main__':
     df = pd.DataFrame(data, columns=['node_id', 'max_change', 'min_likelyhood', 'max_likelyhood', 'gradient'])
 
     # find the as-is likelyhoods
-    iters = 10000
     graph = build_graph(None)[0][1]
-    output_nodes = {2: 0, 7: 0, 8: 0, 9: 0, 10: 0, 11: 0, 12: 0}
-    for _ in range(iters):
-        outnid = graph.get_outcome_node()
-        output_nodes[outnid] += 1
+    output_nodes = graph.outcome_node_distribution()
 
     data = []
     for node_id in output_nodes.keys():
         if node_id != 2:
-            data.append([node_id, float(output_nodes[node_id]) / iters])
+            data.append([node_id, output_nodes[node_id]])
     df2 = pd.DataFrame(data, columns=['node_id', 'frequency'])
 
     # plot it all
@@ -68,7 +68,7 @@ def validate(y, categories, truth):
 if __name__ == '__main__':
     # train a frequency estimator
     X, y = make_data(n_samples=100000)
-    clf = FrequencyEstimator(verbose=True, num_simulations=1)
+    clf = FrequencyEstimator(verbose=True)
     clf.fit(X, y)
 
     X_test, y_test = make_data(n_samples=10000)
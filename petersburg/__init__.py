@@ -10,13 +10,17 @@
 
 from petersburg.edges import Edge
 from petersburg.nodes import Node
+from petersburg.compiled import CompiledGraph
 from petersburg.graph import Graph
 from petersburg.estimators import FrequencyEstimator, MixedModeEstimator
+from petersburg.stats import StreamingStats
 
 __all__ = [
     'Node',
     'MixedModeEstimator',
     'Graph',
     'Edge',
-    'FrequencyEstimator'
+    'FrequencyEstimator',
+    'CompiledGraph',
+    'StreamingStats'
 ]
\ No newline at end of file
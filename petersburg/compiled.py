@@ -0,0 +1,982 @@
+"""
+.. module:: compiled
+   :platform: Unix, Windows
+   :synopsis:
+
+.. moduleauthor:: Will McGinnis <will@pedalwrencher.com>
+
+
+"""
+
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import heapq
+import os
+import numpy as np
+from petersburg.stats import StreamingStats
+
+__author__ = 'willmcginnis'
+
+# walks are handed out (and seeded) in chunks of this many, so results don't depend on how many workers run them
+CHUNK_SIZE = 10000
+
+# rough cap, in bytes, on the dense (edges x rows) matrices outcome_probabilities works on at once
+MEMORY_BUDGET = 256 * 2 ** 20
+
+SAMPLING_MODES = ('plain', 'antithetic', 'stratified', 'importance')
+
+# share of the true edge probabilities mixed into importance sampling's tilted ones
+IMPORTANCE_MIXTURE = 0.1
+
+_worker_state = {}
+
+
+def check_seed_sequence(random_state):
+    """
+    Turns None (fresh entropy), an int or a SeedSequence into a numpy SeedSequence.
+
+    :param random_state:
+    :return:
+    """
+
+    if isinstance(random_state, np.random.SeedSequence):
+        return random_state
+    return np.random.SeedSequence(random_state)
+
+
+def clone_seed_sequence(seed_sequence):
+    """
+    A fresh copy of a SeedSequence, which will spawn the same children the original did when it was new.
+
+    :param seed_sequence:
+    :return:
+    """
+
+    return np.random.SeedSequence(
+        seed_sequence.entropy,
+        spawn_key=seed_sequence.spawn_key,
+        pool_size=seed_sequence.pool_size
+    )
+
+
+def effective_n_jobs(n_jobs):
+    """
+    The number of worker processes to use: -1 means one per CPU.
+
+    :param n_jobs:
+    :return:
+    """
+
+    if n_jobs is None:
+        return 1
+    if n_jobs < 0:
+        return max(1, (os.cpu_count() or 1) + 1 + n_jobs)
+    return max(1, n_jobs)
+
+
+def allocate_strata(n, probs):
+    """
+    Splits n walkers over strata with probabilities probs, in proportion, but giving every stratum that can happen at
+    least one walker. Returns None if there are fewer walkers than possible strata.
+
+    :param n:
+    :param probs:
+    :return:
+    """
+
+    possible = probs > 0
+    n_possible = int(np.sum(possible))
+    if n < n_possible:
+        return None
+
+    share = (n - n_possible) * probs
+    counts = possible.astype(np.int64) + np.floor(share).astype(np.int64)
+
+    # hand out what's left over to the largest remainders
+    left = n - int(np.sum(counts))
+    if left > 0:
+        counts[np.argsort(-(share - np.floor(share)), kind='stable')[:left]] += 1
+
+    return counts
+
+
+def walk_chunk(compiled, task):
+    return compiled.walk(**task)
+
+
+def stats_chunk(compiled, task):
+    """
+    Walks a chunk and returns only a StreamingStats summary of its profits (less the task's 'shift', if any), so that
+    nothing bigger than a summary ever has to be kept or sent back from a worker.
+
+    :param compiled:
+    :param task:
+    :return:
+    """
+
+    task = dict(task)
+    shift = task.pop('shift', 0.0)
+    profits, _ = compiled.walk(**task)
+
+    return StreamingStats().update(profits - shift)
+
+
+def ruin_chunk(compiled, task):
+    """
+    Walks a block of bankroll trajectories (task 'trajectories' rows of task 'games' games each, starting from task
+    'starting_bank') and returns, per trajectory, the number of games played when the bank first hit 0 (0 if it never
+    did) and the final bank (0 if ruined).
+
+    :param compiled:
+    :param task:
+    :return:
+    """
+
+    task = dict(task)
+    trajectories = task.pop('trajectories')
+    games = task.pop('games')
+    starting_bank = task.pop('starting_bank')
+
+    profits, _ = compiled.walk(trajectories * games, **task)
+    banks = starting_bank + np.cumsum(profits.reshape(trajectories, games), axis=1)
+
+    # first passage: the first game after which the bank is at or below 0
+    broke = banks <= 0
+    ruined = np.any(broke, axis=1)
+    time_to_ruin = np.where(ruined, np.argmax(broke, axis=1) + 1, 0)
+    final_bank = np.where(ruined, 0.0, banks[:, -1])
+
+    return time_to_ruin, final_bank
+
+
+def _init_worker(compiled, func):
+    _worker_state['compiled'] = compiled
+    _worker_state['func'] = func
+
+
+def _run_worker_task(task):
+    return _worker_state['func'](_worker_state['compiled'], task)
+
+
+class CompiledGraph(object):
+    """
+    A frozen, array backed form of a graph.  Nodes are numbered 0..n_nodes-1 in topological order (so the start node is
+    always 0 and every edge goes from a lower index to a higher one), and the edges leaving each node are stored
+    contiguously in CSR form:
+
+     * node_ids: the original node id of each node index
+     * payoffs: the payoff of each node
+     * offsets: the edges leaving node i are offsets[i]:offsets[i + 1]
+     * children: the index of the node each edge leads to
+     * costs: the cost of each edge
+     * weights: the static weight of each edge (nan for classifier edges)
+     * cum_probs: the cumulative edge probability within each node (nan for nodes with classifier edges)
+     * classifiers: a dict of edge index: classifier for edges weighted by a model
+
+    Build one with Graph.compile() rather than directly.
+
+    """
+    def __init__(self, node_ids, payoffs, offsets, children, costs, weights, classifiers=None, is_acyclic=True):
+        self.node_ids = list(node_ids)
+        self.payoffs = np.asarray(payoffs, dtype=float)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.children = np.asarray(children, dtype=np.int64)
+        self.costs = np.asarray(costs, dtype=float)
+        self.weights = np.asarray(weights, dtype=float)
+        self.classifiers = classifiers or {}
+        self.is_acyclic = is_acyclic
+
+        self.sources = np.repeat(np.arange(self.n_nodes, dtype=np.int64), np.diff(self.offsets))
+        self.is_terminal = self.offsets[:-1] == self.offsets[1:]
+        self.is_dynamic = np.zeros(self.n_nodes, dtype=bool)
+        if self.classifiers:
+            self.is_dynamic[self.sources[sorted(self.classifiers.keys())]] = True
+        self._classifier_columns = dict([(edge_idx, col) for col, edge_idx in enumerate(sorted(self.classifiers))])
+
+        # classifier edges get a placeholder weight, so their nan can't spread into the running sum of later nodes, and
+        # walks over X can keep their search keys sorted (their nodes are handled separately)
+        self._placeholder_cum_probs = self._cumulative(np.where(np.isnan(self.weights), 1.0, self.weights))
+        self.cum_probs = self._placeholder_cum_probs.copy()
+        self.cum_probs[self.is_dynamic[self.sources]] = np.nan
+
+        self._levels = None
+        self._node_id_array = None
+
+    @classmethod
+    def from_start_node(cls, start_node):
+        """
+        Walks every node reachable from start_node (without recursion) and packs them into arrays.
+
+        :param start_node:
+        :return:
+        """
+
+        # first find everything reachable, and how many edges point into each node
+        indegree = {start_node: 0}
+        stack = [start_node]
+        while stack:
+            node = stack.pop()
+            for edge, _ in node.outcomes:
+                child = edge.to_node
+                if child in indegree:
+                    indegree[child] += 1
+                else:
+                    indegree[child] = 1
+                    stack.append(child)
+
+        # then number the nodes in topological order (kahn's algorithm), so that the start node is 0
+        order = []
+        queue = deque([start_node])
+        remaining = dict(indegree)
+        while queue:
+            node = queue.popleft()
+            order.append(node)
+            for edge, _ in node.outcomes:
+                remaining[edge.to_node] -= 1
+                if remaining[edge.to_node] == 0:
+                    queue.append(edge.to_node)
+
+        # anything left over sits on a cycle, we can still walk it, but can't solve it exactly
+        is_acyclic = len(order) == len(indegree)
+        if not is_acyclic:
+            seen = set(order)
+            order.extend([node for node in indegree if node not in seen])
+
+        index = dict([(node, idx) for idx, node in enumerate(order)])
+
+        offsets = [0]
+        children, costs, weights = [], [], []
+        classifiers = {}
+        for node in order:
+            for edge, w in node.outcomes:
+                if isinstance(w, float) or isinstance(w, int):
+                    weights.append(w)
+                else:
+                    classifiers[len(children)] = w
+                    weights.append(np.nan)
+                children.append(index[edge.to_node])
+                costs.append(edge.cost)
+            offsets.append(len(children))
+
+        return cls(
+            [node.node_id for node in order],
+            [node.payoff for node in order],
+            offsets,
+            children,
+            costs,
+            weights,
+            classifiers=classifiers,
+            is_acyclic=is_acyclic
+        )
+
+    @property
+    def n_nodes(self):
+        return len(self.node_ids)
+
+    @property
+    def n_edges(self):
+        return self.children.shape[0]
+
+    @property
+    def node_id_array(self):
+        """
+        node_ids as a numpy array, numeric if the ids are all numbers of one type, and an object array otherwise (so
+        tuple ids stay tuples, and mixed ints and floats aren't all turned into floats).
+
+        :return:
+        """
+
+        if self._node_id_array is None:
+            ids = np.asarray(self.node_ids) if self.node_ids else np.zeros(0, dtype=np.int64)
+            same_type = ids.ndim == 1 and ids.dtype.kind in 'biuf' and \
+                [type(v) for v in ids.tolist()] == [type(v) for v in self.node_ids]
+            if not same_type:
+                ids = np.empty(self.n_nodes, dtype=object)
+                ids[:] = self.node_ids
+            self._node_id_array = ids
+
+        return self._node_id_array
+
+    def edge_weights(self, feature_vector=None):
+        """
+        Returns the weight of every edge, with classifier edges evaluated (once each) against feature_vector.
+
+        :param feature_vector:
+        :return:
+        """
+
+        weights = self.weights.copy()
+        for edge_idx, clf in self.classifiers.items():
+            weights[edge_idx] = clf.predict_proba(feature_vector)[0][1]
+
+        return weights
+
+    def chunk_tasks(self, iters, random_state=None, X=None, **kwargs):
+        """
+        Splits iters walks (per row of X, if passed) into tasks for run_chunks, each a dict of keyword arguments for
+        walk with its own independent child of the random_state SeedSequence.  The split only depends on iters and X.
+        With common_random_numbers the children come from a copy of random_state, so reusing one SeedSequence always
+        gives the same streams.
+
+        :param iters:
+        :param random_state:
+        :param X:
+        :return:
+        """
+
+        if X is None:
+            sizes = [min(CHUNK_SIZE, iters - lo) for lo in range(0, iters, CHUNK_SIZE)]
+        else:
+            # keep all of a row's walks in one chunk, so its classifier probabilities are only computed once
+            rows_per_chunk = max(1, CHUNK_SIZE // max(iters, 1))
+            sizes = [min(rows_per_chunk, X.shape[0] - lo) for lo in range(0, X.shape[0], rows_per_chunk)]
+
+        seed_sequence = check_seed_sequence(random_state)
+        if kwargs.get('common_random_numbers'):
+            # spawning moves a SeedSequence on, so a shared one would give each graph walked with it different streams
+            seed_sequence = clone_seed_sequence(seed_sequence)
+        seeds = seed_sequence.spawn(len(sizes))
+
+        tasks = []
+        lo = 0
+        for size, seed in zip(sizes, seeds):
+            task = dict(kwargs)
+            task['random_state'] = seed
+            if X is None:
+                task['iters'] = size
+            else:
+                task['iters'] = iters
+                task['X'] = X[lo:lo + size]
+            tasks.append(task)
+            lo += size
+
+        return tasks
+
+    def iter_chunks(self, tasks, n_jobs=1, func=walk_chunk):
+        """
+        Runs func(self, task) for each task, in a pool of n_jobs processes if n_jobs isn't 1, and yields the results in
+        task order.
+
+        :param tasks:
+        :param n_jobs:
+        :param func:
+        :return:
+        """
+
+        n_jobs = min(effective_n_jobs(n_jobs), len(tasks))
+        if n_jobs <= 1:
+            for task in tasks:
+                yield func(self, task)
+        else:
+            with ProcessPoolExecutor(max_workers=n_jobs, initializer=_init_worker, initargs=(self, func)) as executor:
+                for result in executor.map(_run_worker_task, tasks):
+                    yield result
+
+    def run_chunks(self, tasks, n_jobs=1, func=walk_chunk):
+        """
+        Like iter_chunks, but returns all of the results as a list.
+
+        :param tasks:
+        :param n_jobs:
+        :param func:
+        :return:
+        """
+
+        return list(self.iter_chunks(tasks, n_jobs=n_jobs, func=func))
+
+    def simulate(self, iters, start=0, feature_vector=None, random_state=None, n_jobs=1, X=None,
+                 common_random_numbers=False, sampling='plain'):
+        """
+        Like walk, but split into seeded chunks which can be spread over n_jobs processes. For a given random_state the
+        results are the same whatever n_jobs is.
+
+        :param iters:
+        :param start:
+        :param feature_vector:
+        :param random_state:
+        :param n_jobs:
+        :param X:
+        :param common_random_numbers:
+        :param sampling:
+        :return:
+        """
+
+        tasks = self.chunk_tasks(
+            iters,
+            random_state=random_state,
+            X=X,
+            start=start,
+            feature_vector=feature_vector,
+            common_random_numbers=common_random_numbers,
+            sampling=sampling
+        )
+        if len(tasks) == 0:
+            shape = (0, ) if X is None else (0, iters)
+            return np.zeros(shape), np.zeros(shape, dtype=np.int64)
+
+        results = self.run_chunks(tasks, n_jobs=n_jobs)
+
+        return np.concatenate([r[0] for r in results]), np.concatenate([r[1] for r in results])
+
+    def walk(self, iters, start=0, feature_vector=None, random_state=None, X=None, common_random_numbers=False,
+             sampling='plain'):
+        """
+        Walks iters independent games at once from node index start, advancing every unfinished walker by one edge
+        per step.  Returns an array of net profits (terminal payoff less edge costs) and an array of terminal node
+        indices.
+
+        If X is passed, iters games are walked for every row of X, each using its row as the feature vector, and the
+        results are arrays of shape (n_rows, iters).  At each step all of the walkers sitting on the same node are
+        scored together, so each classifier edge sees one predict_proba call per step rather than one per walker, and
+        each (row, edge) probability is only ever computed once and then reused by every later walk of that row.
+
+        With common_random_numbers, every step draws one uniform for every walker (finished or not), so walker i always
+        uses the i-th number of step k's draw. Walks of graphs with the same shape (or of different options) started
+        from the same random_state then line up, and their differences have much lower variance.
+
+        sampling picks a variance reduction scheme. The profits returned are then weighted so that their plain mean is
+        still an unbiased estimate of the expected value (individual profits are no longer outcomes of single games):
+
+         * plain: independent walks.
+         * antithetic: the walkers come in pairs, the second of each pair using 1 - u wherever the first used u. With
+           X, both walkers of a pair belong to the same row.
+         * stratified: the first step is not drawn but allocated, each outcome of the start node getting its share of
+           the walkers, and every profit is scaled by p / (share of walkers) for its first outcome.
+         * importance: edges are drawn with probabilities tilted towards children with large expected absolute
+           payoffs and costs (mixed with the true probabilities, so no outcome is ever ruled out), and every profit is
+           scaled by the likelihood ratio of its path. This needs an acyclic graph.
+
+        Only plain and antithetic sampling can be used with X.
+
+        :param iters:
+        :param start:
+        :param feature_vector:
+        :param random_state:
+        :param X:
+        :param common_random_numbers:
+        :param sampling:
+        :return:
+        """
+
+        if sampling not in SAMPLING_MODES:
+            raise ValueError('sampling must be one of %s, got %r' % (', '.join(SAMPLING_MODES), sampling))
+        if X is not None and sampling in ('stratified', 'importance'):
+            raise ValueError('%s sampling can not be used with X' % (sampling, ))
+
+        rng = np.random.default_rng(random_state)
+        ratios = None
+
+        if X is None:
+            rows = None
+            if sampling == 'importance':
+                probs, ratios = self.importance_probabilities(feature_vector)
+                cum_probs = self._cumulative(probs)
+            elif self.classifiers:
+                cum_probs = self._cumulative(self.edge_weights(feature_vector))
+            else:
+                cum_probs = self.cum_probs
+            n_walkers = iters
+        else:
+            rows = np.repeat(np.arange(X.shape[0]), iters)
+            probability_cache = np.full((X.shape[0], len(self.classifiers)), np.nan)
+            cum_probs = self._placeholder_cum_probs
+            n_walkers = rows.shape[0]
+
+        # offsetting each node's cumulative probabilities by its index makes one sorted array, so a single
+        # searchsorted picks an edge for every walker no matter which node it is sitting on.
+        keys = self.sources + cum_probs
+        last_edge = self.offsets[1:] - 1
+        dynamic = self.is_dynamic if rows is not None else np.zeros(self.n_nodes, dtype=bool)
+
+        position = np.full(n_walkers, start, dtype=np.int64)
+        cost = np.zeros(n_walkers)
+        likelihood = np.ones(n_walkers)
+        if sampling == 'stratified' and not self.is_terminal[start]:
+            lo, hi = self.offsets[start], self.offsets[start + 1]
+            probs = self._probabilities(self.edge_weights(feature_vector))[lo:hi]
+            counts = allocate_strata(n_walkers, probs)
+            if counts is not None:
+                first = np.repeat(np.arange(lo, hi), counts)
+                position = self.children[first]
+                cost = self.costs[first].copy()
+                with np.errstate(divide='ignore', invalid='ignore'):
+                    likelihood = np.repeat(np.where(counts > 0, probs * n_walkers / counts, 0.0), counts)
+
+        active = np.flatnonzero(~self.is_terminal[position])
+        while active.shape[0] > 0:
+            here = position[active]
+            if sampling == 'antithetic':
+                # pairs are made within each row's walks, never across rows
+                n_rows = n_walkers // iters
+                half = rng.random((n_rows, (iters + 1) // 2))
+                draws = np.concatenate([half, 1.0 - half], axis=1)[:, :iters].reshape(-1)[active]
+            elif common_random_numbers:
+                draws = rng.random(n_walkers)[active]
+            else:
+                draws = rng.random(active.shape[0])
+
+            edge = np.searchsorted(keys, here + draws, side='right')
+            edge = np.minimum(edge, last_edge[here])
+
+            on_dynamic = dynamic[here]
+            if np.any(on_dynamic):
+                for node_idx in np.unique(here[on_dynamic]).tolist():
+                    at_node = np.flatnonzero(here == node_idx)
+                    edge[at_node] = self._choose_edges(
+                        node_idx,
+                        X,
+                        rows[active[at_node]],
+                        draws[at_node],
+                        probability_cache
+                    )
+
+            cost[active] += self.costs[edge]
+            if ratios is not None:
+                likelihood[active] *= ratios[edge]
+            position[active] = self.children[edge]
+            active = active[~self.is_terminal[position[active]]]
+
+        profits = likelihood * (self.payoffs[position] - cost)
+        if rows is not None:
+            return profits.reshape(-1, iters), position.reshape(-1, iters)
+        return profits, position
+
+    def _choose_edges(self, node_idx, X, rows, draws, probability_cache):
+        """
+        Picks an edge out of node_idx for each walker, given the row of X it is using and one uniform draw. Classifier
+        probabilities are looked up in probability_cache (rows by classifier edge), and only the rows missing from it
+        are sent to each classifier, in one call per edge.
+
+        :param node_idx:
+        :param X:
+        :param rows:
+        :param draws:
+        :param probability_cache:
+        :return:
+        """
+
+        lo, hi = self.offsets[node_idx], self.offsets[node_idx + 1]
+        weights = np.tile(self.weights[lo:hi], (rows.shape[0], 1))
+        for col, edge_idx in enumerate(range(lo, hi)):
+            if edge_idx in self.classifiers:
+                cache_col = self._classifier_columns[edge_idx]
+                missing = np.unique(rows[np.isnan(probability_cache[rows, cache_col])])
+                if missing.shape[0] > 0:
+                    probability_cache[missing, cache_col] = self.classifiers[edge_idx].predict_proba(X[missing])[:, 1]
+                weights[:, col] = probability_cache[rows, cache_col]
+
+        # first edge whose running total reaches the draw, as in Node.weighted_choice
+        cum = np.cumsum(weights, axis=1)
+        picked = np.sum(cum < (draws * cum[:, -1])[:, np.newaxis], axis=1)
+
+        return lo + np.minimum(picked, hi - lo - 1)
+
+    def importance_probabilities(self, feature_vector=None):
+        """
+        The edge probabilities importance sampling walks with, and the likelihood ratio (true over sampled probability)
+        of each edge. Each edge's probability is tilted by the expected absolute payoffs and costs of a game through it,
+        h(child) + |cost|, where h is solved by a backward pass with absolute payoffs and costs, and the result is mixed
+        with the true probabilities (IMPORTANCE_MIXTURE of them) so that no possible edge is ever given probability 0.
+
+        :param feature_vector:
+        :return:
+        """
+
+        probs = self._probabilities(self.edge_weights(feature_vector))
+        magnitude = self._backward(probs, -np.abs(self.costs), np.abs(self.payoffs))
+
+        tilt = probs * (magnitude[self.children] + np.abs(self.costs))
+        totals = np.bincount(self.sources, weights=tilt, minlength=self.n_nodes)[self.sources]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tilted = np.where(totals > 0, tilt / totals, probs)
+            sampled = (1 - IMPORTANCE_MIXTURE) * tilted + IMPORTANCE_MIXTURE * probs
+            ratios = np.where(sampled > 0, probs / sampled, 0.0)
+
+        return sampled, ratios
+
+    def edge_weight_matrix(self, X):
+        """
+        Returns an (n_edges, n_rows) matrix of edge weights for the rows of X, with each classifier edge scoring all of
+        X in a single predict_proba call.
+
+        :param X:
+        :return:
+        """
+
+        weights = np.repeat(self.weights[:, np.newaxis], X.shape[0], axis=1)
+        for edge_idx, clf in self.classifiers.items():
+            weights[edge_idx] = clf.predict_proba(X)[:, 1]
+
+        return weights
+
+    def outcome_probabilities(self, X, columns=None):
+        """
+        The exact probability of a game ending on each terminal node, for every row of X used as the feature vector.
+        Returns an (n_rows, n_terminal) matrix, with columns in the order of the terminal nodes' indices, or picked
+        out by columns (positions in that order) if passed. The rows are pushed forward together, as one column each of
+        the probability matrices, in blocks of as many rows as keep the dense matrices of a block within MEMORY_BUDGET.
+
+        :param X:
+        :param columns:
+        :return:
+        """
+
+        if columns is None:
+            columns = np.arange(int(np.sum(self.is_terminal)))
+
+        if not self.classifiers:
+            # every row sees the same weights
+            reach = self.reach_probabilities()[self.is_terminal][columns]
+            return np.tile(reach, (X.shape[0], 1))
+
+        blocks = [block[:, columns] for block in self._outcome_blocks(X)]
+        if len(blocks) == 0:
+            return np.zeros((0, len(columns)))
+
+        return np.vstack(blocks)
+
+    def most_likely_outcomes(self, X, columns=None):
+        """
+        For every row of X, the position (in the terminal nodes' order, or in columns if passed) of the terminal node a
+        game is most likely to end on. Like outcome_probabilities, but each block is reduced to its argmax straight
+        away, so the whole (n_rows, n_terminal) matrix is never held at once.
+
+        :param X:
+        :param columns:
+        :return:
+        """
+
+        if columns is None:
+            columns = np.arange(int(np.sum(self.is_terminal)))
+
+        if not self.classifiers:
+            reach = self.reach_probabilities()[self.is_terminal][columns]
+            return np.full(X.shape[0], np.argmax(reach), dtype=np.int64)
+
+        best = [np.argmax(block[:, columns], axis=1) for block in self._outcome_blocks(X)]
+        if len(best) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        return np.concatenate(best)
+
+    def _outcome_blocks(self, X):
+        """
+        Yields (n_block_rows, n_terminal) outcome probabilities for consecutive blocks of the rows of X, each block as
+        large as MEMORY_BUDGET allows.
+
+        :param X:
+        :return:
+        """
+
+        # weights, probabilities and their temporaries per edge, totals and reach per node, 8 bytes each
+        row_bytes = 8 * (4 * self.n_edges + 2 * self.n_nodes)
+        rows_per_block = max(1, MEMORY_BUDGET // row_bytes)
+
+        for lo in range(0, X.shape[0], rows_per_block):
+            probs = self._probabilities(self.edge_weight_matrix(X[lo:lo + rows_per_block]))
+            yield self._forward(probs)[self.is_terminal].T
+
+    def expected_values(self, feature_vector=None):
+        """
+        Solves the expected net profit of a game started from every node, exactly, in one backward pass over the
+        edges.  Like a walk, a game only collects the payoff of the terminal node it ends on, so a node's value is its
+        payoff if it is terminal and sum(p_i * (value(child_i) - cost_i)) otherwise.
+
+        :param feature_vector:
+        :return:
+        """
+
+        probs = self._probabilities(self.edge_weights(feature_vector))
+
+        return self._backward(probs, self.costs, self.payoffs)
+
+    def profit_bounds(self):
+        """
+        The lowest and highest net profit any game started from each node can end with, over every path whatever its
+        probability, from min and max backward passes over the edges.
+
+        :return:
+        """
+
+        if not self.is_acyclic:
+            raise ValueError('Profit bounds can only be solved exactly on an acyclic graph')
+
+        low = np.where(self.is_terminal, self.payoffs, np.inf)
+        high = np.where(self.is_terminal, self.payoffs, -np.inf)
+        for edges in self._get_levels():
+            np.minimum.at(low, self.sources[edges], low[self.children[edges]] - self.costs[edges])
+            np.maximum.at(high, self.sources[edges], high[self.children[edges]] - self.costs[edges])
+
+        return low, high
+
+    def reach_probabilities(self, feature_vector=None):
+        """
+        The probability that a game passes through each node, pushed forward from the start node a level of edges at
+        a time.
+
+        :param feature_vector:
+        :return:
+        """
+
+        return self._forward(self._probabilities(self.edge_weights(feature_vector)))
+
+    def evaluate_scenarios(self, costs=None, weights=None, payoffs=None, feature_vector=None):
+        """
+        Solves many variants of this graph's parameters at once, without building any nodes. costs and weights are
+        (n_scenarios, n_edges) matrices and payoffs an (n_scenarios, n_nodes) matrix, with columns in the compiled
+        order (see edge_keys and node_ids). Any of them left out (or passed as a single row) is shared by every
+        scenario. Returns an (n_scenarios, ) array of the start node's expected value, and an (n_scenarios, n_nodes)
+        array of the probability of each game ending on each node.
+
+        :param costs:
+        :param weights:
+        :param payoffs:
+        :param feature_vector:
+        :return:
+        """
+
+        costs = self._scenario_matrix(costs, self.costs, 'costs')
+        weights = self._scenario_matrix(weights, self.edge_weights(feature_vector), 'weights')
+        payoffs = self._scenario_matrix(payoffs, self.payoffs, 'payoffs')
+
+        n_scenarios = max(costs.shape[1], weights.shape[1], payoffs.shape[1])
+        for name, matrix in [('costs', costs), ('weights', weights), ('payoffs', payoffs)]:
+            if matrix.shape[1] not in (1, n_scenarios):
+                raise ValueError('%s has %d scenarios, expected %d' % (name, matrix.shape[1], n_scenarios))
+
+        probs = self._probabilities(weights)
+        if probs.shape[1] != n_scenarios:
+            probs = np.repeat(probs, n_scenarios, axis=1)
+
+        values = self._backward(probs, costs, payoffs)
+        reach = self._forward(probs)
+        outcomes = np.where(self.is_terminal[:, np.newaxis], reach, 0.0)
+
+        return values[0], outcomes.T
+
+    @property
+    def edge_keys(self):
+        return list(zip([self.node_ids[idx] for idx in self.sources.tolist()],
+                        [self.node_ids[idx] for idx in self.children.tolist()]))
+
+    def _scenario_matrix(self, matrix, default, name):
+        """
+        Lays out a scenario matrix (or the default vector) with one column per scenario, to line up with the per edge
+        and per node arrays.
+
+        :param matrix:
+        :param default:
+        :param name:
+        :return:
+        """
+
+        if matrix is None:
+            matrix = default
+        matrix = np.atleast_2d(np.asarray(matrix, dtype=float))
+        if matrix.shape[1] != default.shape[0]:
+            raise ValueError('%s must have %d columns, got %d' % (name, default.shape[0], matrix.shape[1]))
+
+        return matrix.T
+
+    def _backward(self, probs, costs, payoffs):
+        """
+        The backward pass behind expected_values. probs and costs are per edge and payoffs per node, either as vectors
+        or with one column per scenario (vectors are shared by every scenario).
+
+        :param probs:
+        :param costs:
+        :param payoffs:
+        :return:
+        """
+
+        if not self.is_acyclic:
+            raise ValueError('Expected values can only be solved exactly on an acyclic graph')
+
+        shape = np.broadcast(probs[:1], costs[:1]).shape[1:]
+        terminal = self.is_terminal.reshape((-1, ) + (1, ) * len(shape))
+        values = np.where(terminal, payoffs, 0.0) * np.ones(shape)
+        for edges in self._get_levels():
+            contribution = probs[edges] * (values[self.children[edges]] - costs[edges])
+            np.add.at(values, self.sources[edges], contribution)
+
+        return values
+
+    def _forward(self, probs):
+        """
+        The forward pass behind reach_probabilities, for a vector of edge probabilities or one column per scenario.
+
+        :param probs:
+        :return:
+        """
+
+        if not self.is_acyclic:
+            raise ValueError('Reach probabilities can only be solved exactly on an acyclic graph')
+
+        reach = np.zeros((self.n_nodes, ) + probs.shape[1:])
+        reach[0] = 1.0
+        for edges in reversed(self._get_levels()):
+            np.add.at(reach, self.children[edges], reach[self.sources[edges]] * probs[edges])
+
+        return reach
+
+    def top_k_paths(self, k, feature_vector=None):
+        """
+        Finds the k most probable paths from the start node to a terminal node, most probable first, as a list of
+        (node indices, probability, net profit) tuples.
+
+        This is a best-first (A*) search over -log p edge weights. A partial path is ranked by its own log probability
+        plus the best log probability of any way on from where it stands (solved by a max-product backward pass), which
+        is exact, so paths come off the heap in order and the search stops after the k-th. Edges with probability 0, and
+        nodes with no possible way on, are never expanded.
+
+        :param k:
+        :param feature_vector:
+        :return:
+        """
+
+        if not self.is_acyclic:
+            raise ValueError('Top paths can only be found on an acyclic graph')
+
+        with np.errstate(divide='ignore'):
+            log_probs = np.log(self._probabilities(self.edge_weights(feature_vector)))
+
+        # best log probability of finishing from each node, a level at a time
+        best = np.where(self.is_terminal, 0.0, -np.inf)
+        for edges in self._get_levels():
+            np.maximum.at(best, self.sources[edges], log_probs[edges] + best[self.children[edges]])
+
+        offsets = self.offsets.tolist()
+        children = self.children.tolist()
+        log_probs_list = log_probs.tolist()
+        costs = self.costs.tolist()
+        best_list = best.tolist()
+
+        # each entry is (node index, entry it came from, log probability, cost), the heap holds entry indices
+        entries = [(0, -1, 0.0, 0.0)]
+        heap = [(-best_list[0], 0)]
+        found = []
+        while heap and len(found) < k:
+            _, entry_idx = heapq.heappop(heap)
+            node_idx, _, log_prob, cost = entries[entry_idx]
+            if offsets[node_idx] == offsets[node_idx + 1]:
+                found.append(entry_idx)
+                continue
+
+            for edge_idx in range(offsets[node_idx], offsets[node_idx + 1]):
+                child = children[edge_idx]
+                bound = log_prob + log_probs_list[edge_idx] + best_list[child]
+                if bound == -np.inf:
+                    continue
+                entries.append((child, entry_idx, log_prob + log_probs_list[edge_idx], cost + costs[edge_idx]))
+                heapq.heappush(heap, (-bound, len(entries) - 1))
+
+        paths = []
+        for entry_idx in found:
+            node_idx, _, log_prob, cost = entries[entry_idx]
+            path = []
+            while entry_idx >= 0:
+                path.append(entries[entry_idx][0])
+                entry_idx = entries[entry_idx][1]
+            paths.append((path[::-1], float(np.exp(log_prob)), float(self.payoffs[node_idx] - cost)))
+
+        return paths
+
+    def sensitivities(self, feature_vector=None):
+        """
+        Derivatives of the start node's expected value with respect to every edge cost, edge weight and node payoff,
+        from one backward pass (expected values) and one forward pass (reach probabilities). Returns three arrays,
+        indexed by edge, edge and node:
+
+         * d/d cost_e = -reach(from) * p_e
+         * d/d weight_e = reach(from) * (value(to) - cost_e - value(from)) / sum of the weights out of from
+         * d/d payoff_v = reach(v) for terminal nodes, and 0 otherwise (only terminal payoffs are collected)
+
+        For a classifier edge the weight is its predicted probability for feature_vector.
+
+        :param feature_vector:
+        :return:
+        """
+
+        weights = self.edge_weights(feature_vector)
+        values = self.expected_values(feature_vector=feature_vector)
+        reach = self.reach_probabilities(feature_vector=feature_vector)
+        probs = self._probabilities(weights)
+
+        totals = np.bincount(self.sources, weights=weights, minlength=self.n_nodes)[self.sources]
+        from_reach = reach[self.sources]
+
+        d_cost = -from_reach * probs
+        with np.errstate(divide='ignore', invalid='ignore'):
+            d_weight = np.where(
+                totals != 0,
+                from_reach * (values[self.children] - self.costs - values[self.sources]) / totals,
+                0.0
+            )
+        d_payoff = np.where(self.is_terminal, reach, 0.0)
+
+        return d_cost, d_weight, d_payoff
+
+    def _get_levels(self):
+        """
+        Groups the edges by the height of their source node (the longest path from it to a terminal node), lowest
+        first. Every child sits on a lower level than its parents, so a backward pass can handle a level at a time.
+
+        :return:
+        """
+
+        if self._levels is None:
+            offsets = self.offsets.tolist()
+            children = self.children.tolist()
+            height = [0] * self.n_nodes
+            for node_idx in range(self.n_nodes - 1, -1, -1):
+                lo, hi = offsets[node_idx], offsets[node_idx + 1]
+                if hi > lo:
+                    height[node_idx] = 1 + max([height[c] for c in children[lo:hi]])
+
+            edge_height = np.asarray(height, dtype=np.int64)[self.sources]
+            order = np.argsort(edge_height, kind='stable')
+            bounds = np.flatnonzero(np.diff(edge_height[order])) + 1
+            self._levels = np.split(order, bounds) if order.shape[0] > 0 else []
+
+        return self._levels
+
+    def _probabilities(self, weights):
+        """
+        Normalizes edge weights (a vector, or one column per scenario) into probabilities within each node. A node whose
+        weights sum to zero always takes its first edge.
+
+        :param weights:
+        :return:
+        """
+
+        totals = np.zeros((self.n_nodes, ) + weights.shape[1:])
+        np.add.at(totals, self.sources, weights)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            probs = weights / totals[self.sources]
+
+        dead = totals[self.sources] == 0
+        probs[dead] = 0.0
+        first_edges = np.zeros(self.n_edges, dtype=bool)
+        first_edges[self.offsets[:-1][~self.is_terminal]] = True
+        probs[dead & first_edges.reshape((-1, ) + (1, ) * (weights.ndim - 1))] = 1.0
+
+        return probs
+
+    def _cumulative(self, weights):
+        """
+        Turns a vector of edge weights into cumulative probabilities within each node.  The last edge of every node is
+        pinned to exactly 1.
+
+        :param weights:
+        :return:
+        """
+
+        running = np.cumsum(self._probabilities(weights))
+        base = np.concatenate([[0.0], running])[self.offsets[:-1]]
+        cum = running - base[self.sources]
+        cum[self.offsets[1:][~self.is_terminal] - 1] = 1.0
+
+        return cum
+
+    def __repr__(self):
+        return 'CompiledGraph: %d nodes, %d edges' % (self.n_nodes, self.n_edges)
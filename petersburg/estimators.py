@@ -1,20 +1,228 @@
 from sklearn.base import BaseEstimator, ClassifierMixin
 from sklearn.linear_model import LogisticRegression
 from petersburg import graph
+from scipy import sparse
 import numpy as np
-from collections import Counter
+import warnings
 
 __author__ = 'willmcginnis'
 
 
+def _encode_categories(y):
+    """
+    Finds the categories (layer, value) present in each column of y, and returns them along with an array the shape of
+    y holding the category index of every entry.
+
+    :param y:
+    :return:
+    """
+
+    categories = []
+    codes = np.zeros(y.shape, dtype=np.int64)
+    for col in range(y.shape[1]):
+        values, inverse = np.unique(y[:, col], return_inverse=True)
+        codes[:, col] = inverse.reshape(-1) + len(categories)
+        categories.extend([(col, value) for value in values.tolist()])
+
+    return categories, codes
+
+
+def _lookup_categories(y, categories, category_index):
+    """
+    Returns an array the shape of y holding the index of every entry's (layer, value) category in category_index. Only
+    the distinct values of each column are looked up, and any that haven't been seen before are appended to categories
+    and category_index as new categories.
+
+    :param y:
+    :param categories:
+    :param category_index:
+    :return:
+    """
+
+    codes = np.zeros(y.shape, dtype=np.int64)
+    for col in range(y.shape[1]):
+        values, inverse = np.unique(y[:, col], return_inverse=True)
+        lookup = []
+        for value in values.tolist():
+            if (col, value) not in category_index:
+                category_index[(col, value)] = len(categories)
+                categories.append((col, value))
+            lookup.append(category_index[(col, value)])
+        codes[:, col] = np.array(lookup, dtype=np.int64)[inverse.reshape(-1)]
+
+    return codes
+
+
+def _count_transitions(codes, dims):
+    """
+    Counts every (layer i category, layer i + 1 category) pair in codes at once, into a sparse dims x dims matrix.
+    Transitions only ever run from one layer to the next, so nearly all of a dense matrix would be zeros.
+
+    :param codes:
+    :param dims:
+    :return:
+    """
+
+    from_codes = codes[:, :-1].reshape(-1)
+    to_codes = codes[:, 1:].reshape(-1)
+    counts = sparse.coo_matrix((np.ones(from_codes.shape[0]), (from_codes, to_codes)), shape=(dims, dims))
+
+    # converting sums up the duplicate entries
+    return counts.tocsr()
+
+
+class _TransitionCounts(object):
+    """
+    Layer to layer transition counts kept as a growable COO buffer, so that adding a batch only costs time in its own
+    size: the buffer's capacity doubles when it fills up, and the number of categories can grow between batches.
+    Whenever the buffer grows to twice what it held after it was last compacted (and at least its initial capacity),
+    its duplicate entries are summed away, so memory stays in proportion to the number of distinct transitions and
+    the summing costs amortized constant time per count.  The counts are summed into a sparse matrix when it is asked
+    for, which compacts the buffer too.
+
+    """
+    def __init__(self, capacity=1024):
+        self.dims = 0
+        self.size = 0
+        self._compacted_size = 0
+        self._min_compaction = capacity
+        self._rows = np.zeros(capacity, dtype=np.int64)
+        self._cols = np.zeros(capacity, dtype=np.int64)
+        self._data = np.zeros(capacity)
+        self._matrix = None
+
+    def add(self, codes, dims):
+        """
+        Adds every (layer i category, layer i + 1 category) pair in codes, with dims categories in all.
+
+        :param codes:
+        :param dims:
+        :return:
+        """
+
+        from_codes = codes[:, :-1].reshape(-1)
+        to_codes = codes[:, 1:].reshape(-1)
+        self._append(from_codes, to_codes, np.ones(from_codes.shape[0]))
+        self.dims = max(self.dims, dims)
+        self._matrix = None
+
+        if self.size > max(2 * self._compacted_size, self._min_compaction):
+            self._compact()
+
+        return self
+
+    def tocsr(self):
+        """
+        The counts as a dims x dims sparse matrix.
+
+        :return:
+        """
+
+        if self._matrix is None:
+            self._compact()
+
+        return self._matrix
+
+    def _compact(self):
+        lo = slice(0, self.size)
+        counts = sparse.coo_matrix(
+            (self._data[lo], (self._rows[lo], self._cols[lo])),
+            shape=(self.dims, self.dims)
+        )
+
+        # converting sums up the duplicate entries, which are then all the buffer has to hold
+        self._matrix = counts.tocsr()
+        summed = self._matrix.tocoo()
+        self.size = 0
+        self._append(summed.row, summed.col, summed.data)
+        self._compacted_size = self.size
+
+    def _append(self, rows, cols, data):
+        needed = self.size + rows.shape[0]
+        if needed > self._rows.shape[0]:
+            capacity = max(2 * self._rows.shape[0], needed)
+            for name in ('_rows', '_cols', '_data'):
+                grown = np.zeros(capacity, dtype=getattr(self, name).dtype)
+                grown[:self.size] = getattr(self, name)[:self.size]
+                setattr(self, name, grown)
+
+        self._rows[self.size:needed] = rows
+        self._cols[self.size:needed] = cols
+        self._data[self.size:needed] = data
+        self.size = needed
+
+
+def _check_num_simulations(num_simulations):
+    """
+    Warns if the deprecated num_simulations was set, predictions are exact now and don't simulate anything.
+
+    :param num_simulations:
+    :return:
+    """
+
+    if num_simulations is not None:
+        warnings.warn(
+            'num_simulations is deprecated and ignored, predictions are computed exactly',
+            DeprecationWarning,
+            stacklevel=3
+        )
+
+
+def _terminal_categories(frequency_matrix):
+    """
+    The indices of the categories that are never followed by anything, which are where every walk of the graph ends.
+
+    :param frequency_matrix:
+    :return:
+    """
+
+    row_sums = np.asarray(frequency_matrix.sum(axis=1)).reshape(-1)
+
+    return np.flatnonzero(row_sums == 0)
+
+
+def _compile_graph(frequency_matrix, categories, classes, clf_matrix=None):
+    """
+    Builds and compiles the petersburg graph for a fitted estimator. Returns the compiled graph, the classes (terminal
+    category indices) and the position of each class among the compiled graph's terminal nodes.
+
+    :param frequency_matrix:
+    :param categories:
+    :param classes:
+    :param clf_matrix:
+    :return:
+    """
+
+    cg = graph.Graph().from_adj_matrix(frequency_matrix, categories, clf_matrix=clf_matrix).compile()
+
+    positions = dict([(node_id, col) for col, node_id in enumerate(cg.node_id_array[cg.is_terminal].tolist())])
+    columns = np.array([positions[c] for c in classes.tolist()], dtype=np.int64)
+
+    return cg, classes, columns
+
+
 class FrequencyEstimator(BaseEstimator, ClassifierMixin):
 
-    def __init__(self, verbose=False, num_simulations=10):
-        self._frequency_matrix = None
+    def __init__(self, verbose=False, num_simulations=None):
+        self._counts = None
+        self._compiled = None
         self.num_simulations = num_simulations
         self._categories = None
+        self._category_index = None
         self.verbose = verbose
 
+    @property
+    def _frequency_matrix(self):
+        if self._counts is None:
+            return None
+        return self._counts.tocsr()
+
+    @property
+    def classes_(self):
+        if self._counts is None:
+            return None
+        return _terminal_categories(self._frequency_matrix)
+
     @property
     def _cateogry_labels(self):
         try:
@@ -34,29 +242,22 @@ class FrequencyEstimator(BaseEstimator, ClassifierMixin):
         :return:
         """
 
-        # set up the frequency matrix based on unique columns present
-        dims = sum([len(set(y[:, col].tolist())) for col in range(y.shape[1])])
-        self._frequency_matrix = np.zeros((dims, dims))
-
-        # set up the categories corresponding to each index
-        self._categories = [(idx, a) for idx, b in enumerate([set(y[:, col].tolist()) for col in range(y.shape[1])]) for a in b]
+        _check_num_simulations(self.num_simulations)
 
-        for ridx in range(y.shape[0]):
-            for fcidx, tcidx in zip(range(0, y.shape[1] - 1), range(1, y.shape[1])):
-                f = self._categories.index((fcidx, y[ridx, fcidx]))
-                t = self._categories.index((tcidx, y[ridx, tcidx]))
+        # set up the categories corresponding to each index, and label every entry of y with them
+        self._categories, codes = _encode_categories(y)
+        self._category_index = dict([(category, idx) for idx, category in enumerate(self._categories)])
 
-                try:
-                    self._frequency_matrix[f, t] += 1
-                except IndexError as e:
-                    if self.verbose:
-                        print('Unknown instance found')
+        # then count every layer to layer transition at once
+        self._counts = _TransitionCounts().add(codes, len(self._categories))
+        self._compiled = None
 
         return self
 
     def partial_fit(self, X, y):
         """
-        Updates an existing fitted model with new information.
+        Updates an existing fitted model with new information. Values of y that haven't been seen before become new
+        categories, at the end of the existing ones, and the cost of an update only depends on the size of the batch.
 
         :return:
         """
@@ -67,54 +268,67 @@ class FrequencyEstimator(BaseEstimator, ClassifierMixin):
 
             return self.fit(X, y)
 
-        for ridx in range(y.shape[0]):
-            for fcidx, tcidx in zip(range(0, y.shape[1] - 1), range(1, y.shape[1])):
-                f = self._categories.index((fcidx, y[ridx, fcidx]))
-                t = self._categories.index((tcidx, y[ridx, tcidx]))
-
-                try:
-                    self._frequency_matrix[f, t] += 1
-                except IndexError as e:
-                    if self.verbose:
-                        print('Unknown instance found')
+        codes = _lookup_categories(y, self._categories, self._category_index)
+        self._counts.add(codes, len(self._categories))
+        self._compiled = None
 
         return self
 
-    def predict(self, X):
+    def _get_compiled(self):
         """
-        Uses the observed adjacency matrix to create a petersburg graph and simulate the outcome for each entry
+        The compiled graph, classes and class columns for the current counts, built once per fit or partial_fit.
+
+        :return:
+        """
+
+        if self._compiled is None:
+            self._compiled = _compile_graph(self._frequency_matrix, self._categories, self.classes_)
+        return self._compiled
+
+    def predict_proba(self, X):
+        """
+        Uses the observed adjacency matrix to create a petersburg graph, and returns the exact probability of each entry
+        ending on each terminal category, as an (n_rows, n_classes) matrix with columns ordered as classes_ (which holds
+        category indices). The graph is kept until the next fit or partial_fit.
 
         :param X:
-        :param y:
         :return:
         """
 
-        g = graph.Graph()
+        cg, _, columns = self._get_compiled()
 
-        g.from_adj_matrix(self._frequency_matrix, self._categories)
+        return cg.outcome_probabilities(X, columns=columns)
 
-        y_hat = np.zeros((X.shape[0], 1))
-        for r_idx in range(y_hat.shape[0]):
-            sims = Counter([g.get_outcome_node(X[r_idx, :].reshape(1, -1)) for _ in range(self.num_simulations)])
-            y_hat[r_idx, 0] = sims.most_common(1)[0][0]
+    def predict(self, X):
+        """
+        Returns the most likely terminal category index for each entry, as an (n_rows, 1) array, without ever holding
+        the full predict_proba matrix. This is exact, so num_simulations is deprecated and ignored.
 
-        return y_hat
+        :param X:
+        :return:
+        """
 
+        cg, classes, columns = self._get_compiled()
+
+        return classes[cg.most_likely_outcomes(X, columns=columns)].reshape(-1, 1).astype(float)
 
 
 class MixedModeEstimator(BaseEstimator, ClassifierMixin):
     """
     Similar to the frequency estimator, but will use a classifier to predict conditional probabilities where possible
     """
-    def __init__(self, verbose=False, num_simulations=10):
+    def __init__(self, verbose=False, num_simulations=None):
 
         self._clf = LogisticRegression
         self._clf_args = {}
 
         self._frequency_matrix = None
         self._clf_matrix = None
+        self._compiled = None
 
         self._categories = None
+        self._category_index = None
+        self.classes_ = None
 
         self._min_samples = 100
         self.num_simulations = num_simulations
@@ -136,29 +350,26 @@ class MixedModeEstimator(BaseEstimator, ClassifierMixin):
         """
 
         # find all of the unique layers in the problem (first index of category tuples)
-        row_sums = self._frequency_matrix.sum(axis=1)
+        row_sums = np.asarray(self._frequency_matrix.sum(axis=1)).reshape(-1)
+
+        if sparse.issparse(self._frequency_matrix):
+            with np.errstate(divide='ignore'):
+                scale = np.where(row_sums != 0, 1.0 / row_sums, 0.0)
+            return sparse.diags(scale).dot(self._frequency_matrix).tocsr()
+
         normed_matrix = self._frequency_matrix / row_sums[:, np.newaxis]
 
         return normed_matrix
 
     def _update_frequencies(self, y):
-        # set up the frequency matrix based on unique columns present
-        dims = sum([len(set(y[:, col].tolist())) for col in range(y.shape[1])])
-        self._frequency_matrix = np.zeros((dims, dims))
-
-        # set up the categories corresponding to each index
-        self._categories = [(idx, a) for idx, b in enumerate([set(y[:, col].tolist()) for col in range(y.shape[1])]) for a in b]
+        # set up the categories corresponding to each index, and label every entry of y with them
+        self._categories, codes = _encode_categories(y)
+        self._category_index = dict([(category, idx) for idx, category in enumerate(self._categories)])
 
-        for ridx in range(y.shape[0]):
-            for fcidx, tcidx in zip(range(0, y.shape[1] - 1), range(1, y.shape[1])):
-                f = self._categories.index((fcidx, y[ridx, fcidx]))
-                t = self._categories.index((tcidx, y[ridx, tcidx]))
-
-                try:
-                    self._frequency_matrix[f, t] += 1
-                except IndexError as e:
-                    if self.verbose:
-                        print('Unknown instance found')
+        # then count every layer to layer transition at once
+        self._frequency_matrix = _count_transitions(codes, len(self._categories))
+        self.classes_ = _terminal_categories(self._frequency_matrix)
+        self._compiled = None
 
         return True
 
@@ -169,61 +380,88 @@ class MixedModeEstimator(BaseEstimator, ClassifierMixin):
         :return:
         """
 
+        _check_num_simulations(self.num_simulations)
+
         # first update the frequencies
         self._update_frequencies(y)
 
-        # empty out the clf matrix
-        self._clf_matrix = [[None for _ in range(len(self._cateogry_labels))] for _ in range(len(self._cateogry_labels))]
+        # empty out the clf matrix, it only holds the (from, to) pairs that get a model
+        self._clf_matrix = {}
 
         # then for any with enough data, try to train a model
-        for r_idx in range(self._frequency_matrix.shape[0]):
-            for c_idx in range(self._frequency_matrix.shape[1]):
-                if self._frequency_matrix[r_idx, c_idx] >= self._min_samples:
-                    if self.verbose:
-                        print('\nFound a sample worth modeling')
-                        print('F[%s,%s]=%s' % (r_idx, c_idx, self._frequency_matrix[r_idx, c_idx]))
-                        print('from label: %s' % (str(self._cateogry_labels[r_idx]), ))
-                        print('to label: %s' % (str(self._cateogry_labels[c_idx]), ))
+        labels = self._cateogry_labels
+        frequencies = sparse.coo_matrix(self._frequency_matrix)
+        for r_idx, c_idx, cnt in zip(frequencies.row.tolist(), frequencies.col.tolist(), frequencies.data.tolist()):
+            if cnt >= self._min_samples:
+                if self.verbose:
+                    print('\nFound a sample worth modeling')
+                    print('F[%s,%s]=%s' % (r_idx, c_idx, cnt))
+                    print('from label: %s' % (str(labels[r_idx]), ))
+                    print('to label: %s' % (str(labels[c_idx]), ))
 
-                    filter_col = self._cateogry_labels[r_idx][0]
-                    filter_term = self._cateogry_labels[r_idx][1]
+                filter_col = labels[r_idx][0]
+                filter_term = labels[r_idx][1]
 
-                    label_col = self._cateogry_labels[c_idx][0]
-                    label_term = self._cateogry_labels[c_idx][1]
+                label_col = labels[c_idx][0]
+                label_term = labels[c_idx][1]
 
-                    # filter down X and y to only samples which came from the from_label (index, value)
-                    X_t = X[y[:, filter_col] == filter_term]
-                    y_t = y[y[:, filter_col] == filter_term]
+                # filter down X and y to only samples which came from the from_label (index, value)
+                X_t = X[y[:, filter_col] == filter_term]
+                y_t = y[y[:, filter_col] == filter_term]
 
-                    # filter down y to only the to_node index
-                    y_t = y_t[:, label_col]
+                # filter down y to only the to_node index
+                y_t = y_t[:, label_col]
 
-                    # create bool for if its to the correct option
-                    y_t = y_t == label_term
+                # create bool for if its to the correct option
+                y_t = y_t == label_term
 
-                    try:
-                        self._clf_matrix[r_idx][c_idx] = self._clf(**self._clf_args).fit(X_t, y_t)
-                    except ValueError as e:
-                        self._clf_matrix[r_idx][c_idx] = None
+                try:
+                    self._clf_matrix[(r_idx, c_idx)] = self._clf(**self._clf_args).fit(X_t, y_t)
+                except ValueError as e:
+                    self._clf_matrix[(r_idx, c_idx)] = None
 
         return self
 
-    def predict(self, X):
+    def _get_compiled(self):
         """
-        Uses the observed adjacency matrix to create a petersburg graph and simulate the outcome for each entry
+        The compiled graph, classes and class columns for the fitted counts and classifiers, built once per fit.
+
+        :return:
+        """
+
+        if self._compiled is None:
+            self._compiled = _compile_graph(
+                self._frequency_matrix,
+                self._categories,
+                self.classes_,
+                clf_matrix=self._clf_matrix
+            )
+        return self._compiled
+
+    def predict_proba(self, X):
+        """
+        Uses the observed adjacency matrix and the fitted classifiers to create a petersburg graph, and returns the exact
+        probability of each entry ending on each terminal category, as an (n_rows, n_classes) matrix with columns
+        ordered as classes_ (which holds category indices). Each classifier scores all of X in one call, and the graph
+        is kept until the next fit.
 
         :param X:
-        :param y:
         :return:
         """
 
-        g = graph.Graph()
+        cg, _, columns = self._get_compiled()
+
+        return cg.outcome_probabilities(X, columns=columns)
 
-        g.from_adj_matrix(self._frequency_matrix, self._categories, clf_matrix=self._clf_matrix)
+    def predict(self, X):
+        """
+        Returns the most likely terminal category index for each entry, as an (n_rows, 1) array, without ever holding
+        the full predict_proba matrix. This is exact, so num_simulations is deprecated and ignored.
+
+        :param X:
+        :return:
+        """
 
-        y_hat = np.zeros((X.shape[0], 1))
-        for r_idx in range(y_hat.shape[0]):
-            sims = Counter([g.get_outcome_node(X[r_idx, :].reshape(1, -1)) for _ in range(self.num_simulations)])
-            y_hat[r_idx, 0] = sims.most_common(1)[0][0]
+        cg, classes, columns = self._get_compiled()
 
-        return y_hat
+        return classes[cg.most_likely_outcomes(X, columns=columns)].reshape(-1, 1).astype(float)
@@ -9,12 +9,60 @@
 """
 
 import json
+import time
 import numpy as np
+from scipy import sparse
+from scipy.stats import norm
 from petersburg import Node
+from petersburg.compiled import CompiledGraph, CHUNK_SIZE, check_seed_sequence, clone_seed_sequence, ruin_chunk, \
+    stats_chunk
+from petersburg.stats import StreamingStats
 
 __author__ = 'willmcginnis'
 
 
+def _get_clf(clf_matrix, r_idx, c_idx):
+    """
+    Looks up the classifier for the edge r_idx -> c_idx, in either a nested list or a dict keyed by (r_idx, c_idx).
+    Returns None if there isn't one.
+
+    :param clf_matrix:
+    :param r_idx:
+    :param c_idx:
+    :return:
+    """
+
+    if isinstance(clf_matrix, dict):
+        return clf_matrix.get((r_idx, c_idx), None)
+
+    try:
+        return clf_matrix[r_idx][c_idx]
+    except (IndexError, TypeError) as e:
+        return None
+
+
+def _bernstein_width(stats, spread, alpha):
+    """
+    Half width of the two sided empirical Bernstein interval around the mean of stats, for samples that can only span
+    spread, holding with probability at least 1 - alpha. Maurer and Pontil's bound is one sided, so each side gets
+    alpha / 2.
+
+    :param stats:
+    :param spread:
+    :param alpha:
+    :return:
+    """
+
+    if spread == 0:
+        return 0.0
+    if stats.count < 2:
+        return np.inf
+
+    log_term = np.log(4.0 / alpha)
+
+    return np.sqrt(2 * stats.variance * log_term / stats.count) + 7 * spread * log_term / (3 * (stats.count - 1))
+
+
 class Graph(object):
     """
     A graph holds a heirarchy of nodes and edges with payoffs and costs.
@@ -41,7 +89,17 @@ class Graph(object):
 
     """
     def __init__(self):
-        self.start_node = None
+        self._start_node = None
+        self._reset_cache()
+
+    @property
+    def start_node(self):
+        return self._start_node
+
+    @start_node.setter
+    def start_node(self, node):
+        self._start_node = node
+        self._reset_cache()
 
     def from_dict(self, d):
         """
@@ -90,7 +148,9 @@ class Graph(object):
 
     def from_adj_matrix(self, A, labels=None, clf_matrix=None):
         """
-        Takes in a numpy adjacency matrix and forms a petersburg graph from it (of type [col -> row]).
+        Takes in a numpy adjacency matrix and forms a petersburg graph from it (of type [col -> row]). A may also be a
+        scipy.sparse matrix, in which case only its stored entries are visited. clf_matrix can be a nested list indexed
+        [row][col] or a dict keyed by (row, col).
 
         :param A:
         :return:
@@ -103,128 +163,640 @@ class Graph(object):
         if A.shape[0] != A.shape[1]:
             raise ValueError('Adjanceny Matrix must be square')
 
+        # pull out every nonzero entry (and the row sums) at once, for either a dense or a sparse matrix
+        if sparse.issparse(A):
+            A = A.tocoo()
+            A.sum_duplicates()
+            rows, cols, cnts = A.row.astype(np.int64), A.col.astype(np.int64), A.data
+            row_sums = np.bincount(rows, weights=cnts, minlength=A.shape[0])
+        else:
+            A = np.asarray(A)
+            rows, cols = np.nonzero(A)
+            cnts = A[rows, cols]
+            row_sums = np.sum(A, axis=1)
+
+        keep = ~np.isnan(cnts) & (cnts != 0)
+        rows, cols, cnts = rows[keep], cols[keep], cnts[keep]
+
+        # visit the entries column by column, and down each column, to keep the original edge order
+        order = np.lexsort((rows, cols))
+        rows, cols, cnts = rows[order], cols[order], cnts[order]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            weights = np.where(row_sums[rows] != 0.0, cnts / row_sums[rows], 0.0)
+
+        afters = {}
+        bounds = np.concatenate([[0], np.flatnonzero(np.diff(cols)) + 1, [cols.shape[0]]]).tolist()
+        rows_list, cnts_list, weights_list = rows.tolist(), cnts.tolist(), weights.tolist()
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            if hi > lo:
+                c_idx = int(cols[lo])
+                after = []
+                for r_idx, cnt, weight in zip(rows_list[lo:hi], cnts_list[lo:hi], weights_list[lo:hi]):
+                    clf = _get_clf(clf_matrix, r_idx, c_idx)
+                    after.append({
+                        'node_id': r_idx,
+                        'cost': 0,
+                        'weight': clf if clf is not None else weight,
+                        '_weight': weight,
+                        '_cnt': cnt
+                    })
+                afters[c_idx] = after
+
         dict_spec = {}
         for c_idx in range(A.shape[1]):
-            after = []
-            for r_idx in range(A.shape[0]):
-                if A[r_idx, c_idx] != 0.0 and not np.isnan(A[r_idx, c_idx]):
-                    row_sum = np.sum(A[r_idx, :])
-                    if row_sum != 0.0:
-                        weight = A[r_idx, c_idx] / row_sum
-                    else:
-                        weight = 0.0
-                    try:
-                        clf = clf_matrix[r_idx][c_idx]
-                        if clf is not None:
-                            after.append({
-                                'node_id': r_idx,
-                                'cost': 0,
-                                'weight': clf,
-                                '_weight': weight,
-                                '_cnt': A[r_idx, c_idx]
-                            })
-                        else:
-                            after.append({
-                                'node_id': r_idx,
-                                'cost': 0,
-                                'weight': weight,
-                                '_weight': weight,
-                                '_cnt': A[r_idx, c_idx]
-                            })
-                    except (IndexError, TypeError) as e:
-                        after.append({
-                            'node_id': r_idx,
-                            'cost': 0,
-                            'weight': weight,
-                            '_weight': weight,
-                                '_cnt': A[r_idx, c_idx]
-                        })
-
-            if len(after) > 0 or labels[c_idx][0] == 0:
-                dict_spec[c_idx] = {'payoff': 0, 'after': after}
-
-        # add in root node (super hacky)
+            if c_idx in afters or labels[c_idx][0] == 0:
+                dict_spec[c_idx] = {'payoff': 0, 'after': afters.get(c_idx, [])}
+
+        # add in root node (super hacky), any node with nothing before it hangs off of the root, weighted by the sum
+        # of all _cnt values that follow it
+        root_weights = np.bincount(rows, weights=cnts, minlength=A.shape[0]).tolist()
         dict_spec[-1] = {'after': [], 'payoff': 0}
         for k in dict_spec.keys():
             if k != -1 and len(dict_spec[k].get('after', [])) == 0:
-                # the weight is the sum of all _cnt values that follow this node
-                weight = 0
-                for node in dict_spec.keys():
-                    for a in dict_spec[node].get('after', []):
-                        if a.get('node_id', None) == k:
-                            weight += a.get('_cnt', 0)
-
-                dict_spec[k]['after'] = [{'node_id': -1, 'weight': weight, 'cost': 0}]
+                dict_spec[k]['after'] = [{'node_id': -1, 'weight': root_weights[k], 'cost': 0}]
 
         return self.from_dict(dict_spec)
 
-    def get_outcome(self, iters=None, ruin=False, starting_bank=0, feature_vector=None):
+    def compile(self):
+        """
+        Freezes the graph into a CompiledGraph: flat numpy arrays of node payoffs, CSR edge offsets, child indices,
+        edge costs and cumulative edge probabilities.  The result is cached on the graph and used by the simulation
+        and analysis methods. Adding outcomes or setting a new start_node drops the cache, but call this again after
+        changing payoffs, costs or weights of existing nodes and edges by hand.
+
+        :return:
+        """
+
+        if self.start_node is None:
+            raise AttributeError('Graph has no starting node, build it with from_dict or from_adj_matrix first')
+
+        self._reset_cache()
+        self._compiled = CompiledGraph.from_start_node(self.start_node)
+
+        return self._compiled
+
+    def _reset_cache(self):
+        self._compiled = None
+        self._nodes = None
+        self._edges = None
+        self._node_index = None
+        self._cache_version = Node.version
+
+    def _check_cache(self):
+        """
+        Drops the cached compiled graph and node index if any node has gained an outcome since they were built.
+
+        :return:
+        """
+
+        if self._cache_version != Node.version:
+            self._reset_cache()
+
+    def _build_index(self):
+        """
+        Visits every node reachable from the start node once (O(V + E), however many paths reconverge on a node), and
+        caches the nodes, the edges and a node_id: node lookup on the graph.
+
+        :return:
+        """
+
+        nodes, edges = [], []
+        visited = set()
+        stack = [self.start_node]
+        while stack:
+            node = stack.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+            nodes.append(node)
+            for outcome in node.outcomes:
+                edges.append(outcome[0])
+                stack.append(outcome[0].to_node)
+
+        self._nodes = nodes
+        self._edges = edges
+        self._node_index = dict([(node.node_id, node) for node in nodes])
+
+    def _get_compiled(self):
+        self._check_cache()
+        if self._compiled is None:
+            return self.compile()
+        return self._compiled
+
+    def simulate(self, iters, feature_vector=None, random_state=None, n_jobs=1, X=None, common_random_numbers=False,
+                 sampling='plain'):
+        """
+        Walks the graph iters times at once on the compiled form, and returns a numpy array of the net profit of each
+        walk along with an array of the ID of the final node each walk reached.
+
+        If a feature matrix X is passed instead of a single feature_vector, iters walks are run for each row of X and
+        both arrays have shape (n_rows, iters).
+
+        The walks are split into chunks seeded from numpy.random.SeedSequence(random_state), and spread over n_jobs
+        processes (-1 for one per CPU). The same random_state gives the same results for any n_jobs.
+
+        With common_random_numbers, the i-th walk draws the same uniforms at each step as the i-th walk of any other
+        graph (or option) simulated with the same random_state and iters, which makes comparisons between them paired.
+
+        sampling can be 'plain', 'antithetic', 'stratified' (over the start node's outcomes) or 'importance' (towards
+        high payoff branches), see CompiledGraph.walk. Other than with plain sampling the profits are weighted, so
+        their mean is an unbiased estimate of the expected profit, but they aren't the profits of individual games.
+
+        :param iters:
+        :param feature_vector:
+        :param random_state:
+        :param n_jobs:
+        :param X:
+        :param common_random_numbers:
+        :param sampling:
+        :return:
+        """
+
+        cg = self._get_compiled()
+        profits, position = cg.simulate(
+            iters,
+            feature_vector=feature_vector,
+            random_state=random_state,
+            n_jobs=n_jobs,
+            X=X,
+            common_random_numbers=common_random_numbers,
+            sampling=sampling
+        )
+
+        return profits, cg.node_id_array[position]
+
+    def get_outcome(self, iters=None, ruin=False, starting_bank=0, feature_vector=None, random_state=None, n_jobs=1,
+                    common_random_numbers=False, sampling='plain'):
         """
         Starting with the starting node, the graph is walked once, and the profit is returned, run multiple times to get
         an expected value estimate.
 
+        If iters is passed, that many games are played in a row (simulated as one batch) starting with starting_bank,
+        and the final bank is returned. With ruin, the game ends at 0 as soon as the bank hits 0.
+
+        A sampling other than 'plain' (see simulate) makes the final bank an unbiased estimate from weighted games, which
+        converges much faster on heavy tailed graphs. Weighted games aren't real games, so it can't be used with ruin.
+
         :return:
         """
+        if ruin and sampling != 'plain':
+            raise ValueError('ruin can only be used with plain sampling')
+
         if iters is None:
-            payoff, cost = self.start_node.get_outcome(feature_vector)
-            return payoff - cost
-        else:
-            bank = starting_bank
-            for _ in range(iters):
+            if random_state is None and sampling == 'plain':
                 payoff, cost = self.start_node.get_outcome(feature_vector)
-                bank = bank + payoff - cost
-                if ruin:
-                    if bank <= 0:
-                        return 0
-            return bank
+                return payoff - cost
+            profits, _ = self.simulate(1, feature_vector=feature_vector, random_state=random_state, sampling=sampling)
+            return float(profits[0])
+        else:
+            profits, _ = self.simulate(
+                iters,
+                feature_vector=feature_vector,
+                random_state=random_state,
+                n_jobs=n_jobs,
+                common_random_numbers=common_random_numbers,
+                sampling=sampling
+            )
+            if ruin:
+                if np.any(starting_bank + np.cumsum(profits) <= 0):
+                    return 0
+            return starting_bank + float(np.sum(profits))
+
+    def get_ruin(self, iters, trajectories=1000, starting_bank=0, quantiles=(0.05, 0.25, 0.5, 0.75, 0.95),
+                 feature_vector=None, random_state=None, n_jobs=1):
+        """
+        Plays trajectories independent bankrolls of iters games each (what get_outcome(iters, ruin=True) does once), as
+        blocks of trajectories x games matrices, and returns:
+
+         * ruin_probability: the share of bankrolls that hit 0
+         * time_to_ruin: an array of how many games each ruined bankroll lasted
+         * final_banks: an array of the final bank of every trajectory (0 if ruined)
+         * final_bank_quantiles: a dict of quantile: final bank
+
+        :param iters:
+        :param trajectories:
+        :param starting_bank:
+        :param quantiles:
+        :param feature_vector:
+        :param random_state:
+        :param n_jobs:
+        :return:
+        """
 
-    def get_outcome_node(self, feature_vector=None):
+        if iters < 1:
+            raise ValueError('iters must be at least 1, got %s' % (iters, ))
+        if trajectories < 1:
+            raise ValueError('trajectories must be at least 1, got %s' % (trajectories, ))
+
+        cg = self._get_compiled()
+
+        # blocks of whole trajectories around a chunk's worth of games, the split only depends on iters
+        per_block = max(1, CHUNK_SIZE // iters)
+        sizes = [min(per_block, trajectories - lo) for lo in range(0, trajectories, per_block)]
+        seeds = check_seed_sequence(random_state).spawn(len(sizes))
+        tasks = [{
+            'trajectories': size,
+            'games': iters,
+            'starting_bank': starting_bank,
+            'feature_vector': feature_vector,
+            'random_state': seed,
+        } for size, seed in zip(sizes, seeds)]
+
+        results = cg.run_chunks(tasks, n_jobs=n_jobs, func=ruin_chunk)
+        time_to_ruin = np.concatenate([r[0] for r in results])
+        final_banks = np.concatenate([r[1] for r in results])
+
+        return {
+            'ruin_probability': float(np.mean(time_to_ruin > 0)),
+            'time_to_ruin': time_to_ruin[time_to_ruin > 0],
+            'final_banks': final_banks,
+            'final_bank_quantiles': dict(zip(quantiles, np.quantile(final_banks, quantiles).tolist())),
+        }
+
+    def get_outcome_node(self, feature_vector=None, iters=None, random_state=None, n_jobs=1):
         """
-        Starting with the starting node, the graph is walked once, and the ID of the final node reached is returned
+        Starting with the starting node, the graph is walked once, and the ID of the final node reached is returned. If
+        iters is passed, the graph is walked that many times in one batch and an array of final node IDs is returned.
 
         :return:
         """
 
+        if iters is not None:
+            _, node_ids = self.simulate(iters, feature_vector=feature_vector, random_state=random_state, n_jobs=n_jobs)
+            return node_ids
+
+        if random_state is not None:
+            _, node_ids = self.simulate(1, feature_vector=feature_vector, random_state=random_state)
+            return node_ids[0]
+
         node_id = self.start_node.get_outcome_node(feature_vector)
 
         return node_id
 
-    def get_options(self, iters=100, extended_stats=False):
+    def outcome_node_distribution(self, feature_vector=None):
+        """
+        Returns the exact probability of a game ending on each terminal node, as a dict of node_id: probability, found
+        by pushing probability forward from the starting node in topological order. Each classifier edge is scored
+        once for feature_vector.
+
+        :param feature_vector:
+        :return:
+        """
+
+        cg = self._get_compiled()
+        reach = cg.reach_probabilities(feature_vector=feature_vector)
+
+        return dict([(cg.node_ids[node_idx], float(reach[node_idx])) for node_idx in np.flatnonzero(cg.is_terminal)])
+
+    def get_estimate(self, ci_width=None, rel_error=None, confidence=0.95, max_time=None, max_iters=10000000,
+                     batch_size=1000, feature_vector=None, random_state=None):
+        """
+        Simulates games in doubling batches until the confidence interval on the expected profit is narrow enough, and
+        returns a dict of the estimate ('mean'), the interval ('ci'), its 'stderr', the number of games played ('iters')
+        and whether the target was met ('converged').
+
+        The target is a total interval width (ci_width), a half width relative to the mean (rel_error), or both. The
+        run also stops after max_iters games or, if given, max_time seconds.  On an acyclic graph the interval is an
+        empirical Bernstein one (as in get_best_option), which uses the full range of profits a game could pay out, so
+        it can't collapse while a rare outcome hasn't turned up yet, and is exact at once for a graph with only one
+        possible profit. It is widened every batch, so it holds with probability confidence however many batches are
+        run. The range isn't known on a cyclic graph, which falls back to the normal approximation, and then never
+        counts a run whose games have all come out the same as converged.
+
+        :param ci_width:
+        :param rel_error:
+        :param confidence:
+        :param max_time:
+        :param max_iters:
+        :param batch_size:
+        :param feature_vector:
+        :param random_state:
+        :return:
+        """
+
+        if ci_width is None and rel_error is None:
+            raise ValueError('get_estimate needs a ci_width or rel_error target')
+
+        cg = self._get_compiled()
+        seed_sequence = check_seed_sequence(random_state)
+        z = norm.ppf(0.5 + confidence / 2.0)
+        started = time.time()
+
+        spread = None
+        if cg.is_acyclic:
+            low, high = cg.profit_bounds()
+            spread = float(high[0] - low[0])
+
+        stats = StreamingStats()
+        converged = False
+        half_width = np.inf
+        rounds = 0
+        while stats.count < max_iters:
+            size = min(batch_size, max_iters - stats.count)
+            profits, _ = cg.walk(size, feature_vector=feature_vector, random_state=seed_sequence.spawn(1)[0])
+            stats.update(profits)
+            rounds += 1
+
+            if spread is not None:
+                half_width = _bernstein_width(stats, spread, (1.0 - confidence) / (rounds * (rounds + 1)))
+            elif stats.stderr > 0:
+                half_width = z * stats.stderr
+            else:
+                # all equal samples say nothing about rare outcomes that just haven't turned up yet
+                half_width = np.inf
+
+            converged = True
+            if ci_width is not None:
+                converged = converged and 2 * half_width <= ci_width
+            if rel_error is not None:
+                converged = converged and half_width <= rel_error * abs(stats.mean)
+            if converged or (max_time is not None and time.time() - started >= max_time):
+                break
+
+            batch_size = min(2 * batch_size, 100 * CHUNK_SIZE)
+
+        return {
+            'mean': float(stats.mean),
+            'ci': (float(stats.mean - half_width), float(stats.mean + half_width)),
+            'stderr': float(stats.stderr),
+            'iters': int(stats.count),
+            'converged': bool(converged),
+        }
+
+    def expected_value(self, feature_vector=None):
+        """
+        Returns the exact expected profit of one game, solved by dynamic programming over the compiled graph rather
+        than by simulation.
+
+        :param feature_vector:
+        :return:
+        """
+
+        return float(self._get_compiled().expected_values(feature_vector=feature_vector)[0])
+
+    def evaluate_scenarios(self, costs=None, weights=None, payoffs=None, feature_vector=None):
+        """
+        Evaluates many what-if variants of this graph's topology in one vectorized pass, without building any new nodes
+        or edges. costs and weights are (n_scenarios, n_edges) matrices and payoffs is an (n_scenarios, n_nodes) matrix,
+        with columns ordered as compile().edge_keys and compile().node_ids. Anything left out keeps the graph's own
+        values. Returns a dict of:
+
+         * expected_value: an (n_scenarios, ) array of the exact expected profit of a game
+         * outcome_distribution: an (n_scenarios, n_outcomes) array of the probability of ending on each terminal node
+         * outcome_node_ids: the terminal node ids, in column order
+
+        :param costs:
+        :param weights:
+        :param payoffs:
+        :param feature_vector:
+        :return:
+        """
+
+        cg = self._get_compiled()
+        values, outcomes = cg.evaluate_scenarios(
+            costs=costs,
+            weights=weights,
+            payoffs=payoffs,
+            feature_vector=feature_vector
+        )
+
+        return {
+            'expected_value': values,
+            'outcome_distribution': outcomes[:, cg.is_terminal],
+            'outcome_node_ids': [node_id for node_id, terminal in zip(cg.node_ids, cg.is_terminal) if terminal],
+        }
+
+    def sensitivities(self, feature_vector=None):
+        """
+        Returns the exact derivative of the expected profit of a game with respect to every edge cost, edge weight and
+        node payoff, in one linear time pass over the graph, as a dict of:
+
+         * cost: {(from node_id, to node_id): derivative}
+         * weight: {(from node_id, to node_id): derivative}
+         * payoff: {node_id: derivative}
+
+        Parallel edges between the same two nodes have their derivatives added together.
+
+        :param feature_vector:
+        :return:
+        """
+
+        cg = self._get_compiled()
+        d_cost, d_weight, d_payoff = cg.sensitivities(feature_vector=feature_vector)
+
+        cost, weight = {}, {}
+        for key, dc, dw in zip(cg.edge_keys, d_cost.tolist(), d_weight.tolist()):
+            cost[key] = cost.get(key, 0.0) + dc
+            weight[key] = weight.get(key, 0.0) + dw
+
+        return {
+            'cost': cost,
+            'weight': weight,
+            'payoff': dict(zip(cg.node_ids, d_payoff.tolist())),
+        }
+
+    def top_k_paths(self, k, feature_vector=None):
+        """
+        Returns the k most probable paths from the starting node to a terminal node, most probable first, as a list of
+        dicts of 'path' (the node IDs along it), 'probability' and 'profit' (the terminal payoff less the edge costs).
+        Found by a best-first search that only follows paths which could still make the top k, see
+        CompiledGraph.top_k_paths.
+
+        :param k:
+        :param feature_vector:
+        :return:
+        """
+
+        cg = self._get_compiled()
+
+        return [{
+            'path': [cg.node_ids[node_idx] for node_idx in path],
+            'probability': probability,
+            'profit': profit,
+        } for path, probability, profit in cg.top_k_paths(k, feature_vector=feature_vector)]
+
+    def get_options(self, iters=100, extended_stats=False, random_state=None, exact=False, n_jobs=1,
+                    common_random_numbers=False, sampling='plain'):
         """
         Starts with each of the outcomes from the starting node seperately, to get the expected values (using iters
         iterations) for each of the initial options. Returns a dictionary of node_id: expected profit pairs.
 
+        With extended_stats, each option gets a dict of mean, max, min, count, std, stderr and the p5 / p95 quantiles.
+        These come from constant memory streaming summaries, so iters isn't limited by memory.
+
+        With exact, the expected values are solved directly instead of simulated (iters and extended_stats are ignored).
+        Otherwise each option gets its own child of numpy.random.SeedSequence(random_state), and all of the walks are
+        shared out over n_jobs processes. With common_random_numbers every option instead walks the same stream of
+        uniforms (see simulate), so the differences between options are much less noisy.
+
+        sampling picks a variance reduction scheme for the walks (see simulate), and the mean stays unbiased with any
+        of them. The other extended stats change meaning:
+
+         * antithetic: the games are real, so all of the stats describe them, but paired games aren't independent, so
+           the plain stderr would be wrong and is left out (None).
+         * stratified: the stats describe the weighted profits, and the stderr, which would ignore the strata, is left
+           out (None).
+         * importance: the stats describe the weighted profits. These are independent, so the stderr is still right.
+
         :param iters:
         :return:
         """
 
+        cg = self._get_compiled()
+
+        if exact:
+            values = cg.expected_values()
+            return dict([
+                (cg.node_ids[cg.children[edge_idx]], float(values[cg.children[edge_idx]] - cg.costs[edge_idx]))
+                for edge_idx in range(cg.offsets[0], cg.offsets[1])
+            ])
+
+        options = list(range(cg.offsets[0], cg.offsets[1]))
+        if common_random_numbers:
+            seed_sequence = check_seed_sequence(random_state)
+            seeds = [clone_seed_sequence(seed_sequence) for _ in options]
+        else:
+            seeds = check_seed_sequence(random_state).spawn(len(options))
+
+        # hand every chunk of every option to one pool, each chunk comes back as a constant size summary
+        tasks, owners = [], []
+        for option_idx, edge_idx in enumerate(options):
+            option_tasks = cg.chunk_tasks(
+                iters,
+                random_state=seeds[option_idx],
+                start=cg.children[edge_idx],
+                shift=cg.costs[edge_idx],
+                common_random_numbers=common_random_numbers,
+                sampling=sampling
+            )
+            tasks.extend(option_tasks)
+            owners.extend([option_idx] * len(option_tasks))
+
+        summaries = [StreamingStats() for _ in options]
+        for owner, chunk_stats in zip(owners, cg.iter_chunks(tasks, n_jobs=n_jobs, func=stats_chunk)):
+            summaries[owner].merge(chunk_stats)
+
         choice = {}
-        for outcome in self.start_node.outcomes:
-            out = []
-            for _ in range(iters):
-                payoff, cost = outcome[0].get_outcome()
-                out.append(payoff - cost - outcome[0].cost)
+        for option_idx, edge_idx in enumerate(options):
+            node_id = cg.node_ids[cg.children[edge_idx]]
             if not extended_stats:
-                choice.update({outcome[0].to_node.node_id: float(sum(out))/len(out)})
+                choice.update({node_id: float(summaries[option_idx].mean)})
             else:
-                choice.update({
-                    outcome[0].to_node.node_id: {
-                        'mean': float(sum(out))/len(out),
-                        'max': max(out),
-                        'min': min(out),
-                        'count': len(out),
-                    }
-                })
+                option_stats = summaries[option_idx].to_dict()
+                if sampling in ('antithetic', 'stratified'):
+                    option_stats['stderr'] = None
+                choice.update({node_id: option_stats})
         return choice
 
+    def get_best_option(self, confidence=0.95, batch_size=100, max_iters=100000, random_state=None):
+        """
+        Finds the initial option (outcome of the starting node) with the highest expected profit by successive
+        elimination: every option still in contention is simulated batch_size more times per round, and any option whose
+        upper confidence bound falls below the best lower bound is dropped.  The bounds are empirical Bernstein bounds,
+        built from each option's sample variance plus a term for the full range of profits it could possibly pay out
+        (solved exactly from the graph), so they never collapse just because a rare outcome hasn't turned up yet. They
+        are widened every round (a union bound over options and rounds), so when an option is identified it is the
+        best one with probability at least confidence. An option is never simulated more than max_iters times.
+
+        The profit ranges are only known for an acyclic graph.
+
+        Returns a dict with the 'best' node_id, whether it was 'identified' before the budget ran out, the total 'iters'
+        spent, and per-option 'options' stats (as in get_options(extended_stats=True), plus 'eliminated').
+
+        :param confidence:
+        :param batch_size:
+        :param max_iters:
+        :param random_state:
+        :return:
+        """
+
+        cg = self._get_compiled()
+        options = list(range(cg.offsets[0], cg.offsets[1]))
+        if not options:
+            raise ValueError('The starting node has no options to choose between')
+
+        low, high = cg.profit_bounds()
+        ranges = [float(high[cg.children[edge_idx]] - low[cg.children[edge_idx]]) for edge_idx in options]
+
+        seeds = check_seed_sequence(random_state).spawn(len(options))
+        summaries = [StreamingStats() for _ in options]
+        active = list(range(len(options)))
+
+        rounds = 0
+        while len(active) > 1:
+            running = [idx for idx in active if summaries[idx].count < max_iters]
+            if not running:
+                break
+
+            rounds += 1
+            for idx in running:
+                size = min(batch_size, max_iters - summaries[idx].count)
+                profits, _ = cg.walk(size, start=cg.children[options[idx]], random_state=seeds[idx].spawn(1)[0])
+                summaries[idx].update(profits - cg.costs[options[idx]])
+
+            alpha = (1.0 - confidence) / (len(options) * rounds * (rounds + 1))
+            widths = dict([(idx, _bernstein_width(summaries[idx], ranges[idx], alpha)) for idx in active])
+            best_lower = max([summaries[idx].mean - widths[idx] for idx in active])
+            active = [idx for idx in active if summaries[idx].mean + widths[idx] >= best_lower]
+
+        best = max(active, key=lambda idx: summaries[idx].mean)
+
+        report = {}
+        for idx, edge_idx in enumerate(options):
+            option_stats = summaries[idx].to_dict()
+            option_stats['eliminated'] = idx not in active
+            report[cg.node_ids[cg.children[edge_idx]]] = option_stats
+
+        return {
+            'best': cg.node_ids[cg.children[options[best]]],
+            'identified': len(active) == 1,
+            'iters': int(sum([summary.count for summary in summaries])),
+            'options': report,
+        }
+
     def to_tree(self):
         """
+        Returns the graph as a nested dict of node reprs, shared subtrees are built once and reused.
 
         :return:
         """
 
         return self.start_node.to_tree()
 
+    def iter_dict(self):
+        """
+        Generator over (node_id, spec) pairs in topological order, where spec is in the same format from_dict takes. Every
+        node is emitted exactly once, with its parents referred to by ID, so large graphs can be written out one node
+        at a time.
+
+        :return:
+        """
+
+        cg = self._get_compiled()
+
+        # group the edges by the node they lead to, so each node can list what it comes after
+        by_child = np.argsort(cg.children, kind='stable')
+        in_offsets = np.concatenate([[0], np.cumsum(np.bincount(cg.children, minlength=cg.n_nodes))])
+
+        for node_idx in range(cg.n_nodes):
+            after = []
+            for edge_idx in by_child[in_offsets[node_idx]:in_offsets[node_idx + 1]].tolist():
+                after.append({
+                    'node_id': cg.node_ids[cg.sources[edge_idx]],
+                    'cost': float(cg.costs[edge_idx]),
+                    'weight': cg.classifiers.get(edge_idx, float(cg.weights[edge_idx]))
+                })
+            yield cg.node_ids[node_idx], {'payoff': float(cg.payoffs[node_idx]), 'after': after}
+
+    def to_dict(self):
+        """
+        Returns the graph in the format from_dict takes, with each node (and so each shared subtree) listed once.
+
+        :return:
+        """
+
+        return dict(self.iter_dict())
+
     def to_networkx(self):
         """
 
@@ -237,26 +809,37 @@ class Graph(object):
 
         g = nx.DiGraph()
 
-        # first make a node id: obj mapping and add nodes to the graph
-        node_to_node_id = dict([(node, node.node_id) for node in self.node_list()])
-        nodes = list(node_to_node_id.values())
-        g.add_nodes_from(nodes)
-
-        # now iterate through and add in our edges using that mapping
-        edges = list(self.edge_list())
-        for edge in edges:
-            from_node_id = node_to_node_id.get(edge.from_node)
-            to_node_id = node_to_node_id.get(edge.to_node)
-            cost = edge.cost
-            g.add_edge(from_node_id, to_node_id, weight=cost)
+        # add the nodes by id, then the edges between them
+        g.add_nodes_from([node.node_id for node in self.node_list()])
+        for edge in self.edge_list():
+            g.add_edge(edge.from_node.node_id, edge.to_node.node_id, weight=edge.cost)
 
         return g
 
     def edge_list(self):
-        return self.start_node.get_edges(set())
+        self._check_cache()
+        if self._edges is None:
+            self._build_index()
+        return set(self._edges)
 
     def node_list(self):
-        return self.start_node.get_nodes(set())
+        self._check_cache()
+        if self._nodes is None:
+            self._build_index()
+        return set(self._nodes)
+
+    def get_node(self, node_id):
+        """
+        Returns the node object with the given ID, from the cached node index (rebuilt if outcomes have been added).
+
+        :param node_id:
+        :return:
+        """
+
+        self._check_cache()
+        if self._node_index is None:
+            self._build_index()
+        return self._node_index[node_id]
 
     def plot(self, filename):
         """
@@ -9,6 +9,7 @@
 """
 
 from petersburg import Edge
+import bisect
 import random
 
 __author__ = 'willmcginnis'
@@ -20,6 +21,10 @@ class Node():
     probabilistically picking from a selection of outcomes (edges), or possibly having no outcomes, and being the end
     of the game.
     """
+
+    # bumped whenever any node gets a new outcome, so graphs can tell their cached compiled form may be out of date
+    version = 0
+
     def __init__(self, node_id, payoff=0):
         """
 
@@ -29,6 +34,7 @@ class Node():
         self.node_id = node_id
         self.payoff = payoff
         self.outcomes = []
+        self._cumulative_weights = None
 
     def add_outcome(self, node, cost=0, weight=1, classifier=None):
         """
@@ -45,6 +51,10 @@ class Node():
         else:
             self.outcomes.append((Edge(self, node, cost=cost), classifier))
 
+        # the cached sampling table no longer matches the outcomes, and nor does any graph compiled with this node
+        self._cumulative_weights = None
+        Node.version += 1
+
     def get_weights(self, feature_vector=None):
         w_out = []
         for edge, w in self.outcomes:
@@ -56,7 +66,33 @@ class Node():
 
         return w_out
 
+    def _get_cumulative_weights(self):
+        """
+        Running totals of the static outcome weights, built once and kept until add_outcome is called again. Empty if
+        any outcome is weighted by a classifier, as those weights change with the feature vector.
+
+        :return:
+        """
+
+        if self._cumulative_weights is None:
+            cumulative = []
+            upto = 0
+            for _, w in self.outcomes:
+                if not (isinstance(w, float) or isinstance(w, int)):
+                    cumulative = []
+                    break
+                upto += w
+                cumulative.append(upto)
+            self._cumulative_weights = cumulative
+
+        return self._cumulative_weights
+
     def weighted_choice(self, feature_vector=None):
+        cumulative = self._get_cumulative_weights()
+        if cumulative:
+            r = random.uniform(0, cumulative[-1])
+            return self.outcomes[bisect.bisect_left(cumulative, r)][0]
+
         choices = self.get_weights(feature_vector=feature_vector)
         total = sum(w for c, w in choices)
         r = random.uniform(0, total)
@@ -69,52 +105,88 @@ class Node():
 
     def get_outcome(self, feature_vector=None):
         """
+        Walks from this node to a terminal node (iteratively, so arbitrarily deep graphs are fine), and returns the
+        payoff of the terminal node along with the total cost of the edges taken.
 
         :return:
         """
 
-        if self.outcomes == []:
-            return self.payoff, 0
-        else:
-            edge = self.weighted_choice(feature_vector)
-            payoff, cost = edge.get_outcome(feature_vector=feature_vector)
-            return payoff, cost + edge.get_cost()
+        node = self
+        cost = 0
+        while node.outcomes != []:
+            edge = node.weighted_choice(feature_vector)
+            cost += edge.get_cost()
+            node = edge.to_node
+
+        return node.payoff, cost
 
     def get_outcome_node(self, feature_vector=None):
         """
+        Walks from this node to a terminal node and returns its ID.
 
         :return:
         """
 
-        if self.outcomes == []:
-            return self.node_id
-        else:
-            edge = self.weighted_choice(feature_vector)
-            node_id = edge.get_outcome_node(feature_vector=feature_vector)
-            return node_id
+        node = self
+        while node.outcomes != []:
+            node = node.weighted_choice(feature_vector).to_node
+
+        return node.node_id
 
     def to_tree(self):
-        if self.outcomes == []:
-            return {self.__repr__(): None}
-        else:
-            blob = {}
-            for x in self.outcomes:
-                blob.update(x[0].to_node.to_tree())
+        """
+        Nested dict of node reprs, with None at the terminal nodes. Each node's subtree is built once and the same dict
+        is reused wherever paths reconverge on it, so this is linear in the size of the graph (serializing it will still
+        write out every path).
 
-            return {self.__repr__(): blob}
+        :return:
+        """
+
+        subtrees = {}
+        expanded = set()
+        stack = [self]
+        while stack:
+            node = stack[-1]
+            if node in subtrees:
+                stack.pop()
+            elif node not in expanded:
+                expanded.add(node)
+                stack.extend([x[0].to_node for x in reversed(node.outcomes) if x[0].to_node not in subtrees])
+            else:
+                stack.pop()
+                if node.outcomes == []:
+                    subtrees[node] = None
+                else:
+                    blob = {}
+                    for x in node.outcomes:
+                        if x[0].to_node not in subtrees:
+                            raise ValueError('to_tree requires an acyclic graph')
+                        blob.update({x[0].to_node.__repr__(): subtrees[x[0].to_node]})
+                    subtrees[node] = blob
+
+        return {self.__repr__(): subtrees[self]}
 
     def get_nodes(self, node_list):
-        node_list.update({self})
-        if self.outcomes != []:
-            for outcome in self.outcomes:
-                node_list.update(outcome[0].to_node.get_nodes(node_list))
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node in node_list:
+                continue
+            node_list.update({node})
+            stack.extend([outcome[0].to_node for outcome in node.outcomes])
         return node_list
 
     def get_edges(self, edge_list):
-        if self.outcomes != []:
-            for outcome in self.outcomes:
+        visited = set()
+        stack = [self]
+        while stack:
+            node = stack.pop()
+            if node in visited:
+                continue
+            visited.add(node)
+            for outcome in node.outcomes:
                 edge_list.update({outcome[0]})
-                edge_list.update(outcome[0].to_node.get_edges(edge_list))
+                stack.append(outcome[0].to_node)
         return edge_list
 
     def __str__(self):
@@ -0,0 +1,152 @@
+"""
+.. module:: stats
+   :platform: Unix, Windows
+   :synopsis:
+
+.. moduleauthor:: Will McGinnis <will@pedalwrencher.com>
+
+
+"""
+
+import numpy as np
+
+__author__ = 'willmcginnis'
+
+
+class StreamingStats(object):
+    """
+    Constant memory summary statistics over a stream of samples, fed a batch at a time. Keeps the count, the mean and
+    variance (Welford's method, with Chan's update for whole batches), the min and max, and a merging t-digest of at
+    most about compression / 2 centroids for quantiles.  Two summaries can be combined with merge, so chunks simulated
+    separately can be summarized separately.
+
+    """
+    def __init__(self, compression=200):
+        self.compression = compression
+
+        self.count = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+        self.min = np.inf
+        self.max = -np.inf
+
+        self._centroids = np.zeros(0)
+        self._weights = np.zeros(0)
+
+    def update(self, values):
+        """
+        Adds a batch of samples.
+
+        :param values:
+        :return:
+        """
+
+        values = np.asarray(values, dtype=float).reshape(-1)
+        if values.shape[0] == 0:
+            return self
+
+        batch_mean = float(np.mean(values))
+        batch_m2 = float(np.sum((values - batch_mean) ** 2))
+        self._combine(values.shape[0], batch_mean, batch_m2, float(np.min(values)), float(np.max(values)))
+        self._digest(values, np.ones(values.shape[0]))
+
+        return self
+
+    def merge(self, other):
+        """
+        Folds another StreamingStats into this one.
+
+        :param other:
+        :return:
+        """
+
+        if other.count == 0:
+            return self
+
+        self._combine(other.count, other.mean, other._m2, other.min, other.max)
+        self._digest(other._centroids, other._weights)
+
+        return self
+
+    @property
+    def variance(self):
+        if self.count < 2:
+            return 0.0
+        return self._m2 / (self.count - 1)
+
+    @property
+    def std(self):
+        return float(np.sqrt(self.variance))
+
+    @property
+    def stderr(self):
+        if self.count == 0:
+            return 0.0
+        return self.std / np.sqrt(self.count)
+
+    def quantile(self, q):
+        """
+        Estimated q quantile (0 <= q <= 1) from the digest, interpolating between centroid midpoints.
+
+        :param q:
+        :return:
+        """
+
+        if self.count == 0:
+            return np.nan
+
+        total = self._weights.sum()
+        midpoints = np.cumsum(self._weights) - self._weights / 2.0
+        positions = np.concatenate([[0.0], midpoints, [total]])
+        values = np.concatenate([[self.min], self._centroids, [self.max]])
+
+        return float(np.interp(q * total, positions, values))
+
+    def _combine(self, count, mean, m2, low, high):
+        total = self.count + count
+        delta = mean - self.mean
+        self.mean += delta * count / total
+        self._m2 += m2 + delta ** 2 * self.count * count / total
+        self.count = total
+        self.min = min(self.min, low)
+        self.max = max(self.max, high)
+
+    def _digest(self, centroids, weights):
+        """
+        Merges weighted points into the centroids. Points are sorted and grouped by unit-width bins of the k1 scale
+        function, which keeps centroids small in the tails and large in the middle.
+
+        :param centroids:
+        :param weights:
+        :return:
+        """
+
+        centroids = np.concatenate([self._centroids, centroids])
+        weights = np.concatenate([self._weights, weights])
+
+        order = np.argsort(centroids, kind='stable')
+        centroids, weights = centroids[order], weights[order]
+
+        upto = np.cumsum(weights)
+        q = np.minimum(upto / upto[-1], 1.0)
+        k = self.compression / (2 * np.pi) * np.arcsin(2 * q - 1)
+        bins = np.floor(k - k.min()).astype(np.int64)
+
+        starts = np.flatnonzero(np.concatenate([[True], np.diff(bins) != 0]))
+        self._weights = np.add.reduceat(weights, starts)
+        self._centroids = np.add.reduceat(centroids * weights, starts) / self._weights
+
+    def to_dict(self):
+        return {
+            'mean': float(self.mean),
+            'max': float(self.max),
+            'min': float(self.min),
+            'count': int(self.count),
+            'std': self.std,
+            'stderr': float(self.stderr),
+            'p5': self.quantile(0.05),
+            'p95': self.quantile(0.95),
+        }
+
+    def __repr__(self):
+        return 'StreamingStats: n=%d, mean=%s, std=%s' % (self.count, self.mean, self.std)
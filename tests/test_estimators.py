@@ -0,0 +1,155 @@
+from petersburg import *
+from petersburg import compiled
+import numpy as np
+import unittest
+
+__author__ = 'willmcginnis'
+
+
+def make_data(n_samples=2000, seed=0):
+    """
+    Two layers of labels under a shared root: 0 -> {0, 1}, then 0 -> 0 and 1 -> {1, 2}, with the features separating
+    the three leaves.
+
+    """
+
+    rng = np.random.RandomState(seed)
+    leaf = rng.choice([0, 1, 2], size=n_samples, p=[0.6, 0.15, 0.25])
+    y = np.zeros((n_samples, 3), dtype=int)
+    y[:, 1] = (leaf > 0).astype(int)
+    y[:, 2] = leaf
+    X = rng.rand(n_samples, 4) + leaf[:, np.newaxis] * 10.0
+
+    return X, y
+
+
+class TestEstimators(unittest.TestCase):
+    """
+    """
+
+    def test_frequency_estimator(self):
+        X, y = make_data()
+        clf = FrequencyEstimator().fit(X, y)
+        y_hat = clf.predict(X[:50])
+
+        self.assertEqual(y_hat.shape, (50, 1))
+        labels = clf._cateogry_labels
+        self.assertTrue(all([labels[int(v)][0] == 2 for v in y_hat.reshape(-1).tolist()]))
+
+    def test_mixed_mode_estimator(self):
+        X, y = make_data()
+        clf = MixedModeEstimator().fit(X, y)
+        y_hat = clf.predict(X[:200])
+
+        labels = clf._cateogry_labels
+        predicted = [labels[int(v)] for v in y_hat.reshape(-1).tolist()]
+        truth = [(2, v) for v in y[:200, 2].tolist()]
+        self.assertGreater(np.mean([p == t for p, t in zip(predicted, truth)]), 0.95)
+
+    def test_partial_fit(self):
+        X, y = make_data()
+        full = FrequencyEstimator().fit(X, y)
+        partial = FrequencyEstimator().fit(X[:1000], y[:1000]).partial_fit(X[1000:], y[1000:])
+
+        self.assertEqual(full._categories, [(0, 0), (1, 0), (1, 1), (2, 0), (2, 1), (2, 2)])
+        self.assertTrue(np.array_equal(full._frequency_matrix.toarray(), partial._frequency_matrix.toarray()))
+        self.assertEqual(full._frequency_matrix.sum(), 2 * X.shape[0])
+
+    def test_sparse_adj_matrix(self):
+        X, y = make_data()
+        clf = MixedModeEstimator().fit(X, y)
+        normed = clf._get_normalized_adj_matrix()
+
+        self.assertTrue(np.allclose(np.asarray(normed.sum(axis=1)).reshape(-1), [1, 1, 1, 0, 0, 0]))
+
+        dense = Graph().from_adj_matrix(clf._frequency_matrix.toarray(), clf._categories).to_dict()
+        sparse = Graph().from_adj_matrix(clf._frequency_matrix, clf._categories).to_dict()
+        self.assertEqual(dense, sparse)
+
+    def test_reproducible_simulation(self):
+        X, y = make_data()
+        clf = MixedModeEstimator().fit(X, y)
+        g = Graph().from_adj_matrix(clf._frequency_matrix, clf._categories, clf_matrix=clf._clf_matrix)
+
+        # enough rows to be split over several chunks, so the parallel run really uses a pool
+        self.assertGreater(len(g.compile().chunk_tasks(10, X=X)), 1)
+
+        _, serial = g.simulate(10, X=X, random_state=0)
+        _, parallel = g.simulate(10, X=X, random_state=0, n_jobs=2)
+        self.assertTrue(np.array_equal(serial, parallel))
+
+    def test_predict_proba(self):
+        X, y = make_data()
+
+        clf = FrequencyEstimator().fit(X, y)
+        probs = clf.predict_proba(X[:10])
+        self.assertEqual([clf._categories[c] for c in clf.classes_.tolist()], [(2, 0), (2, 1), (2, 2)])
+        self.assertTrue(np.allclose(probs, np.mean(y[:, 2][:, np.newaxis] == [0, 1, 2], axis=0)))
+
+        clf = MixedModeEstimator().fit(X, y)
+        probs = clf.predict_proba(X[:200])
+        self.assertEqual(probs.shape, (200, 3))
+        self.assertTrue(np.allclose(probs.sum(axis=1), 1.0))
+
+        y_hat = clf.predict(X[:200])
+        self.assertTrue(np.array_equal(y_hat.reshape(-1), clf.classes_[np.argmax(probs, axis=1)]))
+        self.assertGreater(np.mean(np.argmax(probs, axis=1) == y[:200, 2]), 0.95)
+
+        # rows are pushed through in blocks sized to the memory budget, which mustn't change anything
+        budget = compiled.MEMORY_BUDGET
+        compiled.MEMORY_BUDGET = 1
+        try:
+            self.assertTrue(np.allclose(clf.predict_proba(X[:200]), probs))
+            self.assertTrue(np.array_equal(clf.predict(X[:200]), y_hat))
+        finally:
+            compiled.MEMORY_BUDGET = budget
+
+        # the compiled graph is kept between calls, until the model is fit again
+        cg = clf._get_compiled()[0]
+        clf.predict(X[:10])
+        self.assertIs(clf._get_compiled()[0], cg)
+        clf.fit(X, y)
+        self.assertIsNot(clf._get_compiled()[0], cg)
+
+        frequency = FrequencyEstimator().fit(X, y)
+        self.assertTrue(np.all(frequency.predict(X[:10]) == frequency.classes_[0]))
+        cg = frequency._get_compiled()[0]
+        frequency.partial_fit(X[:10], y[:10])
+        self.assertIsNot(frequency._get_compiled()[0], cg)
+
+        self.assertWarns(DeprecationWarning, FrequencyEstimator(num_simulations=5).fit, X, y)
+
+    def test_partial_fit_new_categories(self):
+        X, y = make_data()
+        clf = FrequencyEstimator().fit(X[:1000], y[:1000])
+
+        # a fourth leaf turns up in the stream
+        y_new = y[1000:].copy()
+        y_new[:100, 1] = 1
+        y_new[:100, 2] = 3
+        clf.partial_fit(X[1000:], y_new)
+
+        self.assertEqual(clf._categories[-1], (2, 3))
+        self.assertEqual(clf._frequency_matrix.shape, (7, 7))
+        self.assertEqual(clf._frequency_matrix[clf._category_index[(1, 1)], 6], 100)
+        self.assertEqual(clf._frequency_matrix.sum(), 2 * X.shape[0])
+        self.assertEqual(clf.predict_proba(X[:5]).shape, (5, 4))
+
+        # many small batches add up to the same counts as one fit
+        streamed = FrequencyEstimator().fit(X[:10], y[:10])
+        for lo in range(10, X.shape[0], 10):
+            streamed.partial_fit(X[lo:lo + 10], y[lo:lo + 10])
+        full = FrequencyEstimator().fit(X, y)
+        self.assertTrue(np.array_equal(streamed._frequency_matrix.toarray(), full._frequency_matrix.toarray()))
+
+    def test_partial_fit_memory(self):
+        X, y = make_data(n_samples=1000)
+        clf = FrequencyEstimator().fit(X, y)
+        for _ in range(200):
+            clf.partial_fit(X, y)
+
+        # only five distinct transitions, so the buffer never needs much more than a batch's worth of room
+        counts = clf._counts
+        self.assertLessEqual(counts.size, 2 * max(counts._compacted_size, 1024) + 2 * X.shape[0])
+        self.assertLessEqual(counts._rows.shape[0], 8 * X.shape[0])
+        self.assertEqual(counts._data[:counts.size].sum(), 201 * 2 * X.shape[0])
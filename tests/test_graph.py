@@ -1,12 +1,440 @@
 from petersburg import *
+import numpy as np
 import unittest
 
 __author__ = 'willmcginnis'
 
 
+class CountingClassifier(object):
+    """
+    Stand-in classifier whose probability is the first feature, and which counts the rows it is asked to score.
+
+    """
+    def __init__(self):
+        self.rows_scored = 0
+
+    def predict_proba(self, X):
+        self.rows_scored += X.shape[0]
+        return np.hstack([1 - X[:, :1], X[:, :1]])
+
+
+def decision_graph():
+    return Graph().from_dict({
+        1: {'payoff': 0, 'after': []},
+        2: {'payoff': 0, 'after': [{'node_id': 1, 'cost': 10}]},
+        3: {'payoff': 0, 'after': [{'node_id': 1, 'cost': 10}]},
+        4: {'payoff': 0, 'after': [{'node_id': 1, 'cost': 10}]},
+        5: {'payoff': 0, 'after': [{'node_id': 2, 'cost': 5}, {'node_id': 3, 'cost': 10}]},
+        6: {'payoff': 0, 'after': [{'node_id': 2, 'cost': 5, 'weight': 3}, {'node_id': 4, 'cost': 10}]},
+        7: {'payoff': 10, 'after': [{'node_id': 5, 'cost': 0}]},
+        8: {'payoff': 3, 'after': [{'node_id': 5, 'cost': 0}]},
+        9: {'payoff': 10, 'after': [{'node_id': 6, 'cost': 0}]},
+        10: {'payoff': 3, 'after': [{'node_id': 6, 'cost': 0}]},
+    })
+
+
 class TestPetersburg(unittest.TestCase):
     """
     """
 
     def test_petersburg(self):
-        pass
\ No newline at end of file
+        pass
+
+    def test_compile(self):
+        cg = decision_graph().compile()
+
+        self.assertEqual(cg.n_nodes, 10)
+        self.assertEqual(cg.n_edges, 11)
+        self.assertEqual(cg.node_ids[0], 1)
+        self.assertTrue(cg.is_acyclic)
+
+        # topological numbering: every edge points forward
+        self.assertTrue(np.all(cg.sources < cg.children))
+
+        # cumulative probabilities end at 1 in every non-terminal node
+        ends = cg.offsets[1:][~cg.is_terminal] - 1
+        self.assertTrue(np.allclose(cg.cum_probs[ends], 1.0))
+
+        # node 2 has two outcomes with weights 1 and 3
+        two = cg.node_ids.index(2)
+        self.assertTrue(np.allclose(cg.cum_probs[cg.offsets[two]:cg.offsets[two + 1]], [0.25, 1.0]))
+
+        # a classifier on the start node only blanks out the start node's own edges
+        start, static = Node(0), Node(2)
+        start.add_outcome(Node(1), classifier=CountingClassifier())
+        start.add_outcome(static, weight=1)
+        static.add_outcome(Node(3), weight=1)
+        static.add_outcome(Node(4), weight=3)
+        g = Graph()
+        g.start_node = start
+        cg = g.compile()
+
+        self.assertTrue(np.all(np.isnan(cg.cum_probs[:2])))
+        two = cg.node_ids.index(2)
+        self.assertTrue(np.allclose(cg.cum_probs[cg.offsets[two]:cg.offsets[two + 1]], [0.25, 1.0]))
+
+    def test_cache_invalidation(self):
+        g = Graph().from_dict({
+            0: {'payoff': 0, 'after': []},
+            1: {'payoff': 10, 'after': [{'node_id': 0}]},
+            2: {'payoff': 0, 'after': [{'node_id': 0}]},
+        })
+        self.assertEqual(g.expected_value(), 5.0)
+
+        self.assertEqual(len(g.node_list()), 3)
+
+        # a new outcome on a node the graph already compiled
+        g.start_node.add_outcome(Node(3, payoff=100))
+        self.assertEqual(len(g.node_list()), 4)
+        self.assertEqual(len(g.edge_list()), 3)
+        self.assertEqual(g.get_node(3).payoff, 100)
+        self.assertAlmostEqual(g.expected_value(), 110 / 3.0)
+        self.assertTrue(set(g.get_outcome_node(iters=300, random_state=0).tolist()).issuperset({1, 2, 3}))
+
+        # and a whole new start node
+        start = Node(4)
+        start.add_outcome(Node(5, payoff=7))
+        g.start_node = start
+        self.assertEqual(g.expected_value(), 7.0)
+        self.assertEqual(g.get_outcome(iters=10, random_state=0), 70.0)
+
+    def test_tuple_node_ids(self):
+        g = Graph().from_dict({
+            (0, 0): {'payoff': 0, 'after': []},
+            (1, 2): {'payoff': 1, 'after': [{'node_id': (0, 0)}]},
+        })
+        _, node_ids = g.simulate(5, random_state=0)
+
+        self.assertEqual(node_ids.shape, (5, ))
+        self.assertEqual(node_ids[0], (1, 2))
+        self.assertEqual(g.get_outcome_node(random_state=1), (1, 2))
+
+        # mixed ints and floats keep their own types
+        g = Graph().from_dict({0: {'payoff': 0, 'after': []}, 1.5: {'payoff': 1, 'after': [{'node_id': 0}]}})
+        self.assertEqual(g.compile().node_id_array.tolist(), [0, 1.5])
+        self.assertIs(type(g.compile().node_id_array.tolist()[0]), int)
+
+    def test_simulate(self):
+        g = decision_graph()
+        profits, node_ids = g.simulate(20000, random_state=0)
+
+        self.assertEqual(profits.shape, (20000, ))
+        self.assertTrue(set(node_ids.tolist()).issubset({7, 8, 9, 10}))
+        self.assertAlmostEqual(profits.mean(), (-8.5 - 13.5 - 13.5) / 3, delta=0.2)
+
+        options = g.get_options(iters=20000, random_state=0)
+        self.assertAlmostEqual(options[2], -8.5, delta=0.2)
+        self.assertAlmostEqual(options[3], -13.5, delta=0.2)
+
+    def test_expected_value(self):
+        g = decision_graph()
+
+        self.assertAlmostEqual(g.expected_value(), (-8.5 - 13.5 - 13.5) / 3)
+
+        options = g.get_options(exact=True)
+        self.assertEqual(options, {2: -8.5, 3: -13.5, 4: -13.5})
+
+    def test_deep_chain(self):
+        depth = 20000
+        d = {0: {'payoff': 0, 'after': []}}
+        for idx in range(1, depth):
+            d[idx] = {'payoff': 1 if idx == depth - 1 else 0, 'after': [{'node_id': idx - 1, 'cost': 0}]}
+        g = Graph().from_dict(d)
+
+        self.assertEqual(g.get_outcome(), 1)
+        self.assertEqual(g.get_outcome_node(), depth - 1)
+        self.assertEqual(len(g.node_list()), depth)
+        self.assertEqual(len(g.edge_list()), depth - 1)
+        self.assertIn('0', g.to_tree())
+
+    def test_weighted_choice(self):
+        start = Node(0)
+        for idx in range(1, 5):
+            start.add_outcome(Node(idx), weight=idx)
+        counts = dict([(idx, 0) for idx in range(1, 5)])
+        for _ in range(10000):
+            counts[start.weighted_choice().to_node.node_id] += 1
+        self.assertAlmostEqual(counts[4] / 10000.0, 0.4, delta=0.03)
+
+        # adding an outcome has to rebuild the sampling table
+        start.add_outcome(Node(5), weight=1000)
+        self.assertEqual(start.weighted_choice().to_node.node_id, 5)
+
+    def test_reconvergent_enumeration(self):
+        # 40 stacked diamonds, 2 ** 40 paths
+        d = {0: {'payoff': 0, 'after': []}}
+        for layer in range(40):
+            top = 3 * layer
+            d[top + 1] = {'payoff': 0, 'after': [{'node_id': top}]}
+            d[top + 2] = {'payoff': 0, 'after': [{'node_id': top}]}
+            d[top + 3] = {'payoff': 0, 'after': [{'node_id': top + 1}, {'node_id': top + 2}]}
+        g = Graph().from_dict(d)
+
+        self.assertEqual(len(g.node_list()), 121)
+        self.assertEqual(len(g.edge_list()), 160)
+        self.assertEqual(len(g.start_node.get_nodes(set())), 121)
+        self.assertEqual(len(g.start_node.get_edges(set())), 160)
+        self.assertEqual(g.get_node(120).node_id, 120)
+
+    def test_to_dict(self):
+        g = decision_graph()
+        d = g.to_dict()
+
+        self.assertEqual(len(d), 10)
+        self.assertEqual(d[1]['after'], [])
+        self.assertEqual(d[6]['after'], [{'node_id': 2, 'cost': 5.0, 'weight': 3.0}, {'node_id': 4, 'cost': 10.0, 'weight': 1.0}])
+        self.assertEqual(Graph().from_dict(d).get_options(exact=True), g.get_options(exact=True))
+
+        tree = g.to_tree()
+        self.assertIs(tree['1']['2']['5'], tree['1']['3']['5'])
+        self.assertEqual(tree['1']['2']['5'], {'7': None, '8': None})
+
+    def test_classifier_walks(self):
+        clf = CountingClassifier()
+        start = Node(0)
+        start.add_outcome(Node(1, payoff=1), classifier=clf)
+        start.add_outcome(Node(2, payoff=0), weight=0.5)
+        g = Graph()
+        g.start_node = start
+
+        X = np.array([[0.5], [1.0], [0.0]])
+        _, node_ids = g.simulate(200, X=X, random_state=0)
+
+        self.assertEqual(node_ids.shape, (3, 200))
+        self.assertAlmostEqual(np.mean(node_ids[0] == 1), 0.5, delta=0.1)
+        self.assertAlmostEqual(np.mean(node_ids[1] == 1), 2.0 / 3, delta=0.1)
+        self.assertTrue(np.all(node_ids[2] == 2))
+
+        # each row is scored once, however many walks use it
+        self.assertEqual(clf.rows_scored, 3)
+
+    def test_reproducible_parallel(self):
+        g = decision_graph()
+        serial, _ = g.simulate(25000, random_state=42)
+        parallel, _ = g.simulate(25000, random_state=42, n_jobs=2)
+        self.assertTrue(np.array_equal(serial, parallel))
+
+        self.assertEqual(g.get_options(iters=25000, random_state=7), g.get_options(iters=25000, random_state=7, n_jobs=3))
+        self.assertEqual(g.get_outcome(random_state=3), g.get_outcome(random_state=3))
+
+    def test_extended_stats(self):
+        options = decision_graph().get_options(iters=20000, extended_stats=True, random_state=0)
+
+        self.assertEqual(options[2]['count'], 20000)
+        self.assertEqual((options[2]['min'], options[2]['max']), (-12.0, -5.0))
+        self.assertAlmostEqual(options[2]['std'], 3.5, delta=0.05)
+        self.assertAlmostEqual(options[2]['stderr'], 3.5 / np.sqrt(20000), delta=0.001)
+        self.assertEqual((options[2]['p5'], options[2]['p95']), (-12.0, -5.0))
+
+    def test_get_estimate(self):
+        g = decision_graph()
+        estimate = g.get_estimate(ci_width=0.2, random_state=0)
+
+        self.assertTrue(estimate['converged'])
+        self.assertLessEqual(estimate['ci'][1] - estimate['ci'][0], 0.2)
+        self.assertAlmostEqual(estimate['mean'], g.expected_value(), delta=0.2)
+
+        capped = g.get_estimate(ci_width=1e-6, max_iters=5000, random_state=0)
+        self.assertFalse(capped['converged'])
+        self.assertEqual(capped['iters'], 5000)
+
+        # a payoff of 1e6 one time in 10000: the first batches are all 0, which isn't a zero width interval
+        rare = Graph().from_dict({
+            0: {'payoff': 0, 'after': []},
+            1: {'payoff': 1e6, 'after': [{'node_id': 0, 'weight': 1}]},
+            2: {'payoff': 0, 'after': [{'node_id': 0, 'weight': 9999}]},
+        })
+        estimate = rare.get_estimate(ci_width=5, max_iters=20000, random_state=0)
+        self.assertIs(estimate['converged'], False)
+        self.assertEqual(estimate['iters'], 20000)
+
+        # a graph with only one possible profit is exact after the first batch
+        fixed = Graph().from_dict({0: {'payoff': 0, 'after': []}, 1: {'payoff': 5, 'after': [{'node_id': 0, 'cost': 1}]}})
+        for target in ({'ci_width': 0.1}, {'rel_error': 0.01}):
+            estimate = fixed.get_estimate(random_state=0, **target)
+            self.assertIs(estimate['converged'], True)
+            self.assertEqual(estimate['iters'], 1000)
+            self.assertEqual(estimate['ci'], (4.0, 4.0))
+
+    def test_get_best_option(self):
+        result = decision_graph().get_best_option(random_state=0)
+
+        self.assertEqual(result['best'], 2)
+        self.assertTrue(result['identified'])
+        self.assertTrue(result['options'][3]['eliminated'])
+        self.assertFalse(result['options'][2]['eliminated'])
+        self.assertEqual(result['iters'], sum([o['count'] for o in result['options'].values()]))
+        self.assertLess(result['iters'], 3000)
+
+        # option 1 pays 1000 one time in 100 (worth 10), option 2 always pays 1: runs of zeros mustn't rule out 1
+        rare = Graph().from_dict({
+            0: {'payoff': 0, 'after': []},
+            1: {'payoff': 0, 'after': [{'node_id': 0}]},
+            2: {'payoff': 1, 'after': [{'node_id': 0}]},
+            3: {'payoff': 1000, 'after': [{'node_id': 1, 'weight': 1}]},
+            4: {'payoff': 0, 'after': [{'node_id': 1, 'weight': 99}]},
+        })
+        for seed in range(20):
+            result = rare.get_best_option(random_state=seed)
+            self.assertEqual((result['best'], result['identified']), (1, True))
+
+        # single game batches have no variance at all after the first round
+        result = rare.get_best_option(batch_size=1, max_iters=300, random_state=0)
+        self.assertFalse(result['options'][1]['eliminated'])
+
+    def test_get_ruin(self):
+        # a fair coin for 1 a flip, starting with 1: ruined on the first flip half of the time
+        g = Graph().from_dict({
+            0: {'payoff': 0, 'after': []},
+            1: {'payoff': 1, 'after': [{'node_id': 0}]},
+            2: {'payoff': -1, 'after': [{'node_id': 0}]},
+        })
+        ruin = g.get_ruin(50, trajectories=20000, starting_bank=1, random_state=0)
+
+        self.assertEqual(ruin['final_banks'].shape, (20000, ))
+        self.assertTrue(np.all(ruin['final_banks'] >= 0))
+        self.assertAlmostEqual(np.sum(ruin['time_to_ruin'] == 1) / 20000.0, 0.5, delta=0.02)
+
+        # by the ballot theorem a walk from 1 survives 50 flips with probability C(50, 25) / 2 ** 50
+        self.assertAlmostEqual(ruin['ruin_probability'], 1 - 0.1123, delta=0.01)
+
+        self.assertRaises(ValueError, g.get_ruin, 0)
+        self.assertRaises(ValueError, g.get_ruin, 10, trajectories=0)
+
+    def test_sensitivities(self):
+        g = decision_graph()
+        sens = g.sensitivities()
+        spec = g.to_dict()
+        base = g.expected_value()
+
+        def bumped(node_id, key, after_idx=None, eps=1e-6):
+            d = g.to_dict()
+            if after_idx is None:
+                d[node_id][key] += eps
+            else:
+                d[node_id]['after'][after_idx][key] += eps
+            return (Graph().from_dict(d).expected_value() - base) / eps
+
+        for node_id in spec:
+            self.assertAlmostEqual(sens['payoff'][node_id], bumped(node_id, 'payoff'), places=4)
+            for after_idx, after in enumerate(spec[node_id]['after']):
+                key = (after['node_id'], node_id)
+                self.assertAlmostEqual(sens['cost'][key], bumped(node_id, 'cost', after_idx), places=4)
+                self.assertAlmostEqual(sens['weight'][key], bumped(node_id, 'weight', after_idx), places=4)
+
+    def test_evaluate_scenarios(self):
+        g = decision_graph()
+        cg = g.compile()
+        rng = np.random.RandomState(0)
+        costs = rng.randint(0, 10, size=(5, cg.n_edges))
+        weights = rng.randint(1, 10, size=(5, cg.n_edges))
+        result = g.evaluate_scenarios(costs=costs, weights=weights)
+
+        self.assertEqual(result['expected_value'].shape, (5, ))
+        self.assertEqual(sorted(result['outcome_node_ids']), [7, 8, 9, 10])
+        self.assertTrue(np.allclose(result['outcome_distribution'].sum(axis=1), 1.0))
+
+        for scenario in range(5):
+            d = g.to_dict()
+            for edge_idx, (from_id, to_id) in enumerate(cg.edge_keys):
+                for after in d[to_id]['after']:
+                    if after['node_id'] == from_id:
+                        after['cost'] = costs[scenario, edge_idx]
+                        after['weight'] = int(weights[scenario, edge_idx])
+            self.assertAlmostEqual(result['expected_value'][scenario], Graph().from_dict(d).expected_value())
+
+    def test_common_random_numbers(self):
+        g = decision_graph()
+        d = g.to_dict()
+        for after in d[5]['after'] + d[6]['after']:
+            after['cost'] += 1
+        h = Graph().from_dict(d)
+
+        base, _ = g.simulate(5000, random_state=0, common_random_numbers=True)
+        shifted, _ = h.simulate(5000, random_state=0, common_random_numbers=True)
+        self.assertTrue(np.allclose(base - shifted, 1.0))
+
+        # a shared SeedSequence lines up just like an int does
+        seed_sequence = np.random.SeedSequence(0)
+        base, _ = g.simulate(5000, random_state=seed_sequence, common_random_numbers=True)
+        shifted, _ = h.simulate(5000, random_state=seed_sequence, common_random_numbers=True)
+        self.assertTrue(np.allclose(base - shifted, 1.0))
+
+        # options 3 and 4 are mirror images, so paired they come out exactly equal
+        options = g.get_options(iters=2000, random_state=0, common_random_numbers=True)
+        self.assertEqual(options[3], options[4])
+
+    def test_sampling(self):
+        # st petersburg with 20 flips and a fee of 10: payoffs double at each level, and the expected profit is 10
+        d = {1: {'payoff': 0, 'after': []}, 2: {'payoff': 0, 'after': [{'node_id': 1, 'cost': 10}]}}
+        for idx in range(20):
+            d[2 * idx + 3] = {'payoff': 2 ** (idx + 1), 'after': [{'node_id': 2 * (idx + 1)}]}
+            d[2 * idx + 4] = {'payoff': 0, 'after': [{'node_id': 2 * (idx + 1)}]}
+        g = Graph().from_dict(d)
+
+        profits, _ = g.simulate(2000, random_state=0, sampling='importance')
+        self.assertAlmostEqual(profits.mean(), 10.0, delta=0.5)
+        self.assertLess(profits.std(), g.simulate(2000, random_state=0)[0].std() / 10)
+
+        # antithetic pairs split evenly over two equally likely outcomes
+        options = decision_graph().get_options(iters=1000, random_state=0, sampling='antithetic')
+        self.assertEqual(options, {2: -8.5, 3: -13.5, 4: -13.5})
+
+        # paired games aren't independent, so there's no plain stderr for them
+        options = decision_graph().get_options(iters=1000, random_state=0, sampling='antithetic', extended_stats=True)
+        self.assertIsNone(options[2]['stderr'])
+        self.assertEqual((options[2]['min'], options[2]['max']), (-12.0, -5.0))
+
+        # and with X, within each row
+        coin = Graph().from_dict({
+            0: {'payoff': 0, 'after': []},
+            1: {'payoff': 1, 'after': [{'node_id': 0}]},
+            2: {'payoff': 0, 'after': [{'node_id': 0}]},
+        })
+        profits, _ = coin.simulate(10, X=np.zeros((7, 1)), random_state=0, sampling='antithetic')
+        self.assertTrue(np.array_equal(profits.mean(axis=1), np.full(7, 0.5)))
+
+        stratified, _ = decision_graph().simulate(3000, random_state=0, sampling='stratified')
+        self.assertAlmostEqual(stratified.mean(), decision_graph().expected_value(), delta=0.2)
+
+        self.assertAlmostEqual(g.get_outcome(iters=2000, random_state=0, sampling='importance') / 2000, 10.0, delta=0.5)
+        self.assertRaises(ValueError, g.get_outcome, iters=10, ruin=True, sampling='importance')
+        self.assertRaises(ValueError, g.simulate, 10, sampling='sobol')
+
+    def test_outcome_node_distribution(self):
+        dist = decision_graph().outcome_node_distribution()
+
+        # 5 is reached through 3, or through 2 a quarter of the time, and splits evenly between 7 and 8
+        self.assertEqual(sorted(dist), [7, 8, 9, 10])
+        self.assertAlmostEqual(dist[7], (1 / 3.0 + 1 / 3.0 * 0.25) / 2)
+        self.assertAlmostEqual(sum(dist.values()), 1.0)
+
+        clf = CountingClassifier()
+        start = Node(0)
+        start.add_outcome(Node(1, payoff=1), classifier=clf)
+        start.add_outcome(Node(2, payoff=0), weight=0.5)
+        g = Graph()
+        g.start_node = start
+
+        self.assertEqual(g.outcome_node_distribution(feature_vector=np.array([[1.0]])), {1: 2 / 3.0, 2: 1 / 3.0})
+        self.assertEqual(clf.rows_scored, 1)
+
+    def test_top_k_paths(self):
+        paths = decision_graph().top_k_paths(3)
+
+        # 1 -> 2 -> 6 carries a quarter, and 1 -> 3 -> 5 and 1 -> 4 -> 6 a third, of a split two ways
+        self.assertEqual([p['path'] for p in paths], [[1, 3, 5, 7], [1, 3, 5, 8], [1, 4, 6, 9]])
+        self.assertAlmostEqual(paths[0]['probability'], 1 / 6.0)
+        self.assertEqual(paths[0]['profit'], -10.0)
+        self.assertEqual(len(decision_graph().top_k_paths(100)), 8)
+
+        # 2 ** 40 paths through the diamonds, each diamond taking its heavier side three times in four
+        d = {0: {'payoff': 0, 'after': []}}
+        for layer in range(40):
+            top = 3 * layer
+            d[top + 1] = {'payoff': 0, 'after': [{'node_id': top}]}
+            d[top + 2] = {'payoff': 0, 'after': [{'node_id': top, 'weight': 3}]}
+            d[top + 3] = {'payoff': 0, 'after': [{'node_id': top + 1}, {'node_id': top + 2}]}
+        paths = Graph().from_dict(d).top_k_paths(2)
+        self.assertAlmostEqual(paths[0]['probability'], 0.75 ** 40)
+        self.assertAlmostEqual(paths[1]['probability'], 0.75 ** 39 * 0.25)
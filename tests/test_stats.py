@@ -0,0 +1,32 @@
+from petersburg import *
+import numpy as np
+import unittest
+
+__author__ = 'willmcginnis'
+
+
+class TestStreamingStats(unittest.TestCase):
+    """
+    """
+
+    def test_streaming_stats(self):
+        x = np.random.RandomState(0).standard_normal(200000)
+        stats = StreamingStats()
+        for chunk in np.array_split(x, 20):
+            stats.update(chunk)
+
+        self.assertEqual(stats.count, x.shape[0])
+        self.assertAlmostEqual(stats.mean, x.mean())
+        self.assertAlmostEqual(stats.variance, x.var(ddof=1))
+        self.assertEqual((stats.min, stats.max), (x.min(), x.max()))
+        self.assertAlmostEqual(stats.quantile(0.05), np.percentile(x, 5), delta=0.02)
+        self.assertAlmostEqual(stats.quantile(0.95), np.percentile(x, 95), delta=0.02)
+        self.assertLess(len(stats._centroids), 200)
+
+    def test_merge(self):
+        x = np.random.RandomState(1).exponential(size=50000)
+        merged = StreamingStats().update(x[:10000]).merge(StreamingStats().update(x[10000:]))
+
+        self.assertAlmostEqual(merged.mean, x.mean())
+        self.assertAlmostEqual(merged.std, x.std(ddof=1))
+        self.assertAlmostEqual(merged.quantile(0.5), np.median(x), delta=0.02)